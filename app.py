@@ -3,15 +3,38 @@ Live Market Data Web Application
 Real-time Nifty 50 and Bank Nifty data visualization with futures analysis
 """
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, stream_with_context
+import io
 import json
 import pyotp
 import time
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone, timedelta, time as dt_time
 import requests
 import os
+import bisect
+import queue
+import csv
+import functools
+import heapq
+import itertools
+import math
+import operator
+import mmap
+import struct
+import sys
+import threading
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from werkzeug.exceptions import RequestEntityTooLarge
 
+try:
+    import msgpack
+except ImportError:  # Optional: ?format=msgpack is unavailable without it
+    msgpack = None
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
@@ -21,25 +44,118 @@ def get_ist_time():
     ist = timezone(timedelta(hours=5, minutes=30))
     return datetime.now(ist)
 
+# ====== TRADING CALENDAR ======
+NSE_HOLIDAYS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nse_holidays.json')
+PRE_OPEN_START = dt_time(9, 0)
+SESSION_OPEN = dt_time(9, 15)
+SESSION_CLOSE = dt_time(15, 30)
+POST_CLOSE_END = dt_time(16, 0)
+CLOSING_SNAPSHOT_DELAY = timedelta(minutes=5)  # Let closing prices settle before the final snapshot
+POLL_SECONDS_OPEN = int(os.environ.get('POLL_SECONDS_OPEN', 300))
+
+def load_nse_holidays():
+    """{date: description} of NSE trading holidays"""
+    try:
+        with open(NSE_HOLIDAYS_FILE) as f:
+            raw = json.load(f)
+        return {
+            datetime.strptime(day, '%Y-%m-%d').date(): description
+            for year, days in raw.items() if not year.startswith('_')
+            for day, description in days.items()
+        }
+    except Exception as e:
+        print(f"⚠️ Could not load NSE holiday calendar, only weekends will be skipped: {e}")
+        return {}
+
+NSE_HOLIDAYS = load_nse_holidays()
+
+def is_trading_day(day):
+    """True if NSE is open on this date"""
+    return day.weekday() < 5 and day not in NSE_HOLIDAYS
+
+def previous_trading_day(day):
+    """Last trading session strictly before the given date"""
+    day -= timedelta(days=1)
+    while not is_trading_day(day):
+        day -= timedelta(days=1)
+    return day
+
+def next_trading_day(day):
+    """First trading session strictly after the given date"""
+    day += timedelta(days=1)
+    while not is_trading_day(day):
+        day += timedelta(days=1)
+    return day
+
 def get_previous_trading_day():
-    """Get the previous trading day in IST, going back up to 3 days to find valid trading day"""
-    today = get_ist_time().date()
-    
-    # Try going back 1, 2, then 3 days to find a valid trading day
-    for days_back in range(1, 4):  # Try 1, 2, 3 days back
-        candidate_day = today - timedelta(days=days_back)
-        weekday = candidate_day.weekday()  # Monday=0, Sunday=6
-        
-        # Monday=0, Tuesday=1, Wednesday=2, Thursday=3, Friday=4, Saturday=5, Sunday=6
-        if weekday < 5:  # Monday to Friday (0-4)
-            return candidate_day
-    
-    # Fallback: if we couldn't find a weekday in 3 days, go back to last Friday
-    fallback_day = today - timedelta(days=7)  # Go back a week
-    while fallback_day.weekday() >= 5:  # While it's weekend
-        fallback_day = fallback_day - timedelta(days=1)
-    
-    return fallback_day
+    """Get the previous trading day in IST, skipping weekends and NSE holidays"""
+    return previous_trading_day(get_ist_time().date())
+
+def session_datetime(day, at):
+    """IST datetime for a session boundary on the given day"""
+    return datetime.combine(day, at, tzinfo=timezone(timedelta(hours=5, minutes=30)))
+
+def get_market_phase(now=None):
+    """'pre-open', 'open', 'post-close' or 'closed' for the given IST time"""
+    now = now or get_ist_time()
+    if not is_trading_day(now.date()):
+        return 'closed'
+    current = now.time()
+    if PRE_OPEN_START <= current < SESSION_OPEN:
+        return 'pre-open'
+    if SESSION_OPEN <= current < SESSION_CLOSE:
+        return 'open'
+    if SESSION_CLOSE <= current < POST_CLOSE_END:
+        return 'post-close'
+    return 'closed'
+
+def next_session_open(now=None):
+    """IST datetime of the next continuous-session open at or after now"""
+    now = now or get_ist_time()
+    today = now.date()
+    if is_trading_day(today) and now.time() < SESSION_OPEN:
+        return session_datetime(today, SESSION_OPEN)
+    return session_datetime(next_trading_day(today), SESSION_OPEN)
+
+def final_snapshot_pending(now=None, last_update=None):
+    """True if today's session has closed but no snapshot was taken after the close"""
+    now = now or get_ist_time()
+    if not is_trading_day(now.date()) or now.time() < SESSION_CLOSE:
+        return False
+    final_at = session_datetime(now.date(), SESSION_CLOSE) + CLOSING_SNAPSHOT_DELAY
+    return last_update is None or last_update < final_at
+
+def is_refresh_due(now=None):
+    """
+    Whether an upstream refresh is worth paying for right now: always during
+    the session, once after the close, and whenever there is no data at all.
+    """
+    now = now or get_ist_time()
+    if not cached_data.get('last_update'):
+        return True
+    if get_market_phase(now) == 'open':
+        return True
+    return final_snapshot_pending(now, cached_data['last_update']) and \
+        now >= session_datetime(now.date(), SESSION_CLOSE) + CLOSING_SNAPSHOT_DELAY
+
+def get_next_poll_seconds(now=None):
+    """
+    Seconds until the next refresh is worth making, following the session
+    phase. After a failed refresh the next attempt waits at least
+    POLL_SECONDS_OPEN, so an upstream outage is not retried every few seconds.
+    """
+    now = now or get_ist_time()
+    if get_market_phase(now) == 'open':
+        seconds = POLL_SECONDS_OPEN
+    elif final_snapshot_pending(now, cached_data.get('last_update')):
+        final_at = session_datetime(now.date(), SESSION_CLOSE) + CLOSING_SNAPSHOT_DELAY
+        seconds = max(5, int((final_at - now).total_seconds()))
+    else:
+        seconds = max(5, int((next_session_open(now) - now).total_seconds()))
+    failed_at = last_refresh['failed_at']
+    if failed_at is not None:
+        seconds = max(seconds, math.ceil(failed_at + POLL_SECONDS_OPEN - time.monotonic()))
+    return seconds
 
 def test_historical_oi():
     """Test function to verify historical OI API"""
@@ -115,12 +231,12 @@ def get_historical_oi_data(symbol_token):
     
     # Check cache first
     cache_key = f"oi_{symbol_token}"
-    today = get_ist_time().date()
-    
-    if cache_key in cached_data['historical_oi_cache']:
-        cache_date, cache_data = cached_data['historical_oi_cache'][cache_key]
-        if cache_date == today:
-            return cache_data
+    now = get_ist_time()
+    cached_oi = historical_oi_cache.get(cache_key)
+    if cached_oi is not None:
+        return cached_oi
+    # Previous-session OI is valid until the date changes
+    until_midnight = (datetime.combine(now.date() + timedelta(days=1), dt_time(0, 0), tzinfo=now.tzinfo) - now).total_seconds()
     
     if not cached_data['auth_token']:
         if not authenticate():
@@ -130,11 +246,7 @@ def get_historical_oi_data(symbol_token):
     time.sleep(0.5)  # 500ms delay to avoid rate limits
     
     # Try just 1 previous trading day for now to reduce API load
-    target_date = get_ist_time().date() - timedelta(days=1)
-    
-    # Skip weekends
-    while target_date.weekday() >= 5:  # Skip Saturday(5) and Sunday(6)
-        target_date = target_date - timedelta(days=1)
+    target_date = get_previous_trading_day()
     
     from_date = target_date.strftime('%Y-%m-%d 09:15')
     to_date = target_date.strftime('%Y-%m-%d 15:30')
@@ -176,11 +288,11 @@ def get_historical_oi_data(symbol_token):
                     
                     if previous_oi > 0:
                         # Cache the result
-                        cached_data['historical_oi_cache'][cache_key] = (today, previous_oi)
+                        historical_oi_cache.set(cache_key, previous_oi, ttl=until_midnight)
                         return previous_oi
             else:
                 # Cache the failure to avoid repeated API calls
-                cached_data['historical_oi_cache'][cache_key] = (today, 0)
+                historical_oi_cache.set(cache_key, 0, ttl=until_midnight)
         
         return 0
     except Exception as e:
@@ -206,148 +318,222 @@ cached_data = {
     'nifty_futures': None,
     'bank_futures': None,
     'pcr_data': None,
+    'option_chains': {},  # Per-underlying PCR / max pain / OI walls from the last refresh
+    'futures_curves': {},  # Per-underlying near/next/far futures, rollover and calendar spreads
+    'fetch_health': {},  # Batches, retries, hedges and carried-over rows of the last refresh
+    'meters': {},  # ISS meter per futures segment, computed once per published snapshot
+    'baskets': {},  # ISS meter per registered basket, computed once per published snapshot
+    'basis': {},  # Spot-futures basis per joined futures segment, computed once per published snapshot
     'last_update': None,
     'auth_token': None,
-    'historical_oi_cache': {},  # Cache for historical OI data
+    'auth_obtained_at': None,
+    'snapshot_version': 0,  # Bumped on every published snapshot
+    'stale': False,  # True while serving a persisted snapshot after restart
     'chart_data': {  # Store historical data for charts
         'nifty_futures_history': [],
         'bank_futures_history': []
     }
 }
 
-# Updated Nifty 50 Token Mapping with New Weightages (October 2025) - COMPLETE 47 STOCKS
-NIFTY_50_STOCKS = {
-    "11483": {"symbol": "LT-EQ", "name": "LT", "company": "Larsen & Toubro Ltd", "weight": 3.84},
-    "10604": {"symbol": "BHARTIARTL-EQ", "name": "BHARTIARTL", "company": "Bharti Airtel Ltd", "weight": 4.53},
-    "11630": {"symbol": "NTPC-EQ", "name": "NTPC", "company": "NTPC Ltd", "weight": 1.42},
-    "1333": {"symbol": "HDFCBANK-EQ", "name": "HDFCBANK", "company": "HDFC Bank Ltd", "weight": 12.91},
-    "1394": {"symbol": "HINDUNILVR-EQ", "name": "HINDUNILVR", "company": "Hindustan Unilever Ltd", "weight": 1.98},
-    "14977": {"symbol": "POWERGRID-EQ", "name": "POWERGRID", "company": "Power Grid Corporation of India Ltd", "weight": 1.15},
-    "2031": {"symbol": "M&M-EQ", "name": "M&M", "company": "Mahindra & Mahindra Ltd", "weight": 2.69},
-    "17963": {"symbol": "NESTLEIND-EQ", "name": "NESTLEIND", "company": "Nestle India Ltd", "weight": 0.73},
-    "20374": {"symbol": "COALINDIA-EQ", "name": "COALINDIA", "company": "Coal India Ltd", "weight": 0.76},
-    "16675": {"symbol": "BAJAJFINSV-EQ", "name": "BAJAJFINSV", "company": "Bajaj Finserv Ltd", "weight": 1.0},
-    "1964": {"symbol": "TRENT-EQ", "name": "TRENT", "company": "Trent Ltd", "weight": 0.94},
-    "21808": {"symbol": "SBILIFE-EQ", "name": "SBILIFE", "company": "SBI Life Insurance Company Ltd", "weight": 0.7},
-    "22377": {"symbol": "MAXHEALTH-EQ", "name": "MAXHEALTH", "company": "Max Healthcare Institute Ltd", "weight": 0.7},
-    "236": {"symbol": "ASIANPAINT-EQ", "name": "ASIANPAINT", "company": "Asian Paints Ltd", "weight": 0.93},
-    "2885": {"symbol": "RELIANCE-EQ", "name": "RELIANCE", "company": "Reliance Industries Ltd", "weight": 8.08},
-    "3499": {"symbol": "TATASTEEL-EQ", "name": "TATASTEEL", "company": "Tata Steel Ltd", "weight": 1.25},
-    "5900": {"symbol": "AXISBANK-EQ", "name": "AXISBANK", "company": "Axis Bank Ltd", "weight": 2.96},
-    "694": {"symbol": "CIPLA-EQ", "name": "CIPLA", "company": "Cipla Ltd", "weight": 0.75},
-    "383": {"symbol": "BEL-EQ", "name": "BEL", "company": "Bharat Electronics Ltd", "weight": 1.29},
-    "10999": {"symbol": "MARUTI-EQ", "name": "MARUTI", "company": "Maruti Suzuki India Ltd", "weight": 1.82},
-    "11195": {"symbol": "INDIGO-EQ", "name": "INDIGO", "company": "InterGlobe Aviation Ltd", "weight": 1.08},
-    "11723": {"symbol": "JSWSTEEL-EQ", "name": "JSWSTEEL", "company": "JSW Steel Ltd", "weight": 0.95},
-    "11532": {"symbol": "ULTRACEMCO-EQ", "name": "ULTRACEMCO", "company": "UltraTech Cement Ltd", "weight": 1.25},
-    "1232": {"symbol": "GRASIM-EQ", "name": "GRASIM", "company": "Grasim Industries Ltd", "weight": 0.93},
-    "13538": {"symbol": "TECHM-EQ", "name": "TECHM", "company": "Tech Mahindra Ltd", "weight": 0.78},
-    "11536": {"symbol": "TCS-EQ", "name": "TCS", "company": "Tata Consultancy Services Ltd", "weight": 2.6},
-    "1363": {"symbol": "HINDALCO-EQ", "name": "HINDALCO", "company": "Hindalco Industries Ltd", "weight": 0.99},
-    "157": {"symbol": "APOLLOHOSP-EQ", "name": "APOLLOHOSP", "company": "Apollo Hospitals Enterprise Ltd", "weight": 0.66},
-    "1660": {"symbol": "ITC-EQ", "name": "ITC", "company": "ITC Ltd", "weight": 3.41},
-    "18143": {"symbol": "JIOFIN-EQ", "name": "JIOFIN", "company": "Jio Financial Services Ltd", "weight": 0.87},
-    "15083": {"symbol": "ADANIPORTS-EQ", "name": "ADANIPORTS", "company": "Adani Ports and Special Economic Zone Ltd", "weight": 0.92},
-    "1922": {"symbol": "KOTAKBANK-EQ", "name": "KOTAKBANK", "company": "Kotak Mahindra Bank Ltd", "weight": 2.71},
-    "1594": {"symbol": "INFY-EQ", "name": "INFY", "company": "Infosys Ltd", "weight": 4.56},
-    "2475": {"symbol": "ONGC-EQ", "name": "ONGC", "company": "Oil & Natural Gas Corporation Ltd", "weight": 0.83},
-    "25": {"symbol": "ADANIENT-EQ", "name": "ADANIENT", "company": "Adani Enterprises Ltd", "weight": 0.59},
-    "3351": {"symbol": "SUNPHARMA-EQ", "name": "SUNPHARMA", "company": "Sun Pharmaceutical Industries Ltd", "weight": 1.51},
-    "7229": {"symbol": "HCLTECH-EQ", "name": "HCLTECH", "company": "HCL Technologies Ltd", "weight": 1.29},
-    "3787": {"symbol": "WIPRO-EQ", "name": "WIPRO", "company": "Wipro Ltd", "weight": 0.6},
-    "3045": {"symbol": "SBIN-EQ", "name": "SBIN", "company": "State Bank of India", "weight": 3.16},
-    "317": {"symbol": "BAJFINANCE-EQ", "name": "BAJFINANCE", "company": "Bajaj Finance Ltd", "weight": 2.3},
-    "3432": {"symbol": "TATACONSUM-EQ", "name": "TATACONSUM", "company": "Tata Consumer Products Ltd", "weight": 0.65},
-    "3456": {"symbol": "TATAMOTORS-EQ", "name": "TATAMOTORS", "company": "Tata Motors Ltd", "weight": 1.31},
-    "5097": {"symbol": "ETERNAL-EQ", "name": "ETERNAL", "company": "Eternal Materials Co Ltd", "weight": 2.0},
-    "910": {"symbol": "EICHERMOT-EQ", "name": "EICHERMOT", "company": "Eicher Motors Ltd", "weight": 0.84},
-    "881": {"symbol": "DRREDDY-EQ", "name": "DRREDDY", "company": "Dr Reddys Laboratories Ltd", "weight": 0.67},
-    "3506": {"symbol": "TITAN-EQ", "name": "TITAN", "company": "Titan Company Ltd", "weight": 1.25},
-    "4306": {"symbol": "SHRIRAMFIN-EQ", "name": "SHRIRAMFIN", "company": "Shriram Finance Ltd", "weight": 0.79},
-    "467": {"symbol": "HDFCLIFE-EQ", "name": "HDFCLIFE", "company": "HDFC Life Insurance Co Ltd", "weight": 0.71},
-}
+# ====== CACHES ======
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 16 * 1024 * 1024))  # Per cache
 
-# Bank Nifty Token Mapping (October 2025) - COMPLETE 12 STOCKS
-BANK_NIFTY_STOCKS = {
-    "10666": {"symbol": "PNB-EQ", "name": "PNB", "company": "Punjab National Bank", "weight": 1.05},
-    "10794": {"symbol": "CANBK-EQ", "name": "CANBK", "company": "Canara Bank", "weight": 1.13},
-    "1333": {"symbol": "HDFCBANK-EQ", "name": "HDFCBANK", "company": "HDFC Bank Ltd", "weight": 39.1},
-    "21238": {"symbol": "AUBANK-EQ", "name": "AUBANK", "company": "AU Small Finance Bank Ltd", "weight": 1.11},
-    "4963": {"symbol": "ICICIBANK-EQ", "name": "ICICIBANK", "company": "ICICI Bank Ltd", "weight": 25.84},
-    "4668": {"symbol": "BANKBARODA-EQ", "name": "BANKBARODA", "company": "Bank of Baroda", "weight": 1.29},
-    "5900": {"symbol": "AXISBANK-EQ", "name": "AXISBANK", "company": "Axis Bank Ltd", "weight": 8.97},
-    "5258": {"symbol": "INDUSINDBK-EQ", "name": "INDUSINDBK", "company": "IndusInd Bank Ltd", "weight": 1.31},
-    "1023": {"symbol": "FEDERALBNK-EQ", "name": "FEDERALBNK", "company": "Federal Bank Ltd", "weight": 1.25},
-    "11184": {"symbol": "IDFCFIRSTB-EQ", "name": "IDFCFIRSTB", "company": "IDFC First Bank Ltd", "weight": 1.21},
-    "1922": {"symbol": "KOTAKBANK-EQ", "name": "KOTAKBANK", "company": "Kotak Mahindra Bank Ltd", "weight": 8.19},
-    "3045": {"symbol": "SBIN-EQ", "name": "SBIN", "company": "State Bank of India", "weight": 9.56},
-}
+def approx_size(value, depth=3):
+    """Rough deep size in bytes of a cached value (containers followed a few levels down)"""
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        size += sum(approx_size(key, depth - 1) + approx_size(item, depth - 1) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approx_size(item, depth - 1) for item in value)
+    return size
 
-# Nifty 50 Futures Token Mapping (October 28, 2025 Expiry) - COMPLETE 47 FUTURES
-NIFTY_50_FUTURES = {
-    "52274": {"symbol": "BEL28OCT25FUT", "name": "BEL", "company": "Bharat Electronics Ltd", "weight": 1.29},
-    "52351": {"symbol": "GRASIM28OCT25FUT", "name": "GRASIM", "company": "Grasim Industries Ltd", "weight": 0.93},
-    "52442": {"symbol": "LT28OCT25FUT", "name": "LT", "company": "Larsen & Toubro Ltd", "weight": 3.84},
-    "52454": {"symbol": "MARUTI28OCT25FUT", "name": "MARUTI", "company": "Maruti Suzuki India Ltd", "weight": 1.82},
-    "52555": {"symbol": "TRENT28OCT25FUT", "name": "TRENT", "company": "Trent Ltd", "weight": 0.94},
-    "52391": {"symbol": "INDIGO28OCT25FUT", "name": "INDIGO", "company": "InterGlobe Aviation Ltd", "weight": 1.08},
-    "52240": {"symbol": "BAJAJFINSV28OCT25FUT", "name": "BAJAJFINSV", "company": "Bajaj Finserv Ltd", "weight": 1.0},
-    "52455": {"symbol": "MAXHEALTH28OCT25FUT", "name": "MAXHEALTH", "company": "Max Healthcare Institute Ltd", "weight": 0.7},
-    "52509": {"symbol": "RELIANCE28OCT25FUT", "name": "RELIANCE", "company": "Reliance Industries Ltd", "weight": 8.08},
-    "52532": {"symbol": "TATAMOTORS28OCT25FUT", "name": "TATAMOTORS", "company": "Tata Motors Ltd", "weight": 1.31},
-    "52558": {"symbol": "ULTRACEMCO28OCT25FUT", "name": "ULTRACEMCO", "company": "UltraTech Cement Ltd", "weight": 1.25},
-    "52422": {"symbol": "JSWSTEEL28OCT25FUT", "name": "JSWSTEEL", "company": "JSW Steel Ltd", "weight": 0.95},
-    "52474": {"symbol": "NTPC28OCT25FUT", "name": "NTPC", "company": "NTPC Ltd", "weight": 1.42},
-    "52504": {"symbol": "POWERGRID28OCT25FUT", "name": "POWERGRID", "company": "Power Grid Corporation of India Ltd", "weight": 1.15},
-    "52521": {"symbol": "SUNPHARMA28OCT25FUT", "name": "SUNPHARMA", "company": "Sun Pharmaceutical Industries Ltd", "weight": 1.51},
-    "52539": {"symbol": "TCS28OCT25FUT", "name": "TCS", "company": "Tata Consultancy Services Ltd", "weight": 2.6},
-    "52370": {"symbol": "HINDUNILVR28OCT25FUT", "name": "HINDUNILVR", "company": "Hindustan Unilever Ltd", "weight": 1.98},
-    "52568": {"symbol": "WIPRO28OCT25FUT", "name": "WIPRO", "company": "Wipro Ltd", "weight": 0.6},
-    "52176": {"symbol": "ADANIPORTS28OCT25FUT", "name": "ADANIPORTS", "company": "Adani Ports and Special Economic Zone Ltd", "weight": 0.92},
-    "52223": {"symbol": "AXISBANK28OCT25FUT", "name": "AXISBANK", "company": "Axis Bank Ltd", "weight": 2.96},
-    "52446": {"symbol": "M&M28OCT25FUT", "name": "M&M", "company": "Mahindra & Mahindra Ltd", "weight": 2.69},
-    "52466": {"symbol": "NESTLEIND28OCT25FUT", "name": "NESTLEIND", "company": "Nestle India Ltd", "weight": 0.73},
-    "52542": {"symbol": "TECHM28OCT25FUT", "name": "TECHM", "company": "Tech Mahindra Ltd", "weight": 0.78},
-    "52545": {"symbol": "TITAN28OCT25FUT", "name": "TITAN", "company": "Titan Company Ltd", "weight": 1.25},
-    "52241": {"symbol": "BAJFINANCE28OCT25FUT", "name": "BAJFINANCE", "company": "Bajaj Finance Ltd", "weight": 2.3},
-    "52307": {"symbol": "CIPLA28OCT25FUT", "name": "CIPLA", "company": "Cipla Ltd", "weight": 0.75},
-    "52337": {"symbol": "EICHERMOT28OCT25FUT", "name": "EICHERMOT", "company": "Eicher Motors Ltd", "weight": 0.84},
-    "52365": {"symbol": "HDFCLIFE28OCT25FUT", "name": "HDFCLIFE", "company": "HDFC Life Insurance Co Ltd", "weight": 0.71},
-    "52368": {"symbol": "HINDALCO28OCT25FUT", "name": "HINDALCO", "company": "Hindalco Industries Ltd", "weight": 0.99},
-    "52398": {"symbol": "INFY28OCT25FUT", "name": "INFY", "company": "Infosys Ltd", "weight": 4.56},
-    "52513": {"symbol": "SBILIFE28OCT25FUT", "name": "SBILIFE", "company": "SBI Life Insurance Company Ltd", "weight": 0.7},
-    "52514": {"symbol": "SBIN28OCT25FUT", "name": "SBIN", "company": "State Bank of India", "weight": 3.16},
-    "52216": {"symbol": "ASIANPAINT28OCT25FUT", "name": "ASIANPAINT", "company": "Asian Paints Ltd", "weight": 0.93},
-    "52276": {"symbol": "BHARTIARTL28OCT25FUT", "name": "BHARTIARTL", "company": "Bharti Airtel Ltd", "weight": 4.53},
-    "52362": {"symbol": "HCLTECH28OCT25FUT", "name": "HCLTECH", "company": "HCL Technologies Ltd", "weight": 1.29},
-    "52418": {"symbol": "JIOFIN28OCT25FUT", "name": "JIOFIN", "company": "Jio Financial Services Ltd", "weight": 0.87},
-    "52489": {"symbol": "ONGC28OCT25FUT", "name": "ONGC", "company": "Oil & Natural Gas Corporation Ltd", "weight": 0.83},
-    "52527": {"symbol": "TATACONSUM28OCT25FUT", "name": "TATACONSUM", "company": "Tata Consumer Products Ltd", "weight": 0.65},
-    "52534": {"symbol": "TATASTEEL28OCT25FUT", "name": "TATASTEEL", "company": "Tata Steel Ltd", "weight": 1.25},
-    "52174": {"symbol": "ADANIENT28OCT25FUT", "name": "ADANIENT", "company": "Adani Enterprises Ltd", "weight": 0.59},
-    "52214": {"symbol": "APOLLOHOSP28OCT25FUT", "name": "APOLLOHOSP", "company": "Apollo Hospitals Enterprise Ltd", "weight": 0.66},
-    "52308": {"symbol": "COALINDIA28OCT25FUT", "name": "COALINDIA", "company": "Coal India Ltd", "weight": 0.76},
-    "52336": {"symbol": "DRREDDY28OCT25FUT", "name": "DRREDDY", "company": "Dr Reddys Laboratories Ltd", "weight": 0.67},
-    "52364": {"symbol": "HDFCBANK28OCT25FUT", "name": "HDFCBANK", "company": "HDFC Bank Ltd", "weight": 12.91},
-    "52414": {"symbol": "ITC28OCT25FUT", "name": "ITC", "company": "ITC Ltd", "weight": 3.41},
-    "52430": {"symbol": "KOTAKBANK28OCT25FUT", "name": "KOTAKBANK", "company": "Kotak Mahindra Bank Ltd", "weight": 2.71},
-    "52516": {"symbol": "SHRIRAMFIN28OCT25FUT", "name": "SHRIRAMFIN", "company": "Shriram Finance Ltd", "weight": 0.79},
-}
-# Bank Nifty Futures Token Mapping (October 28, 2025 Expiry) - COMPLETE 12 FUTURES  
-BANK_NIFTY_FUTURES = {
-    "52340": {"symbol": "FEDERALBNK28OCT25FUT", "name": "FEDERALBNK", "company": "Federal Bank Ltd", "weight": 1.25},
-    "52256": {"symbol": "BANKBARODA28OCT25FUT", "name": "BANKBARODA", "company": "Bank of Baroda", "weight": 1.29},
-    "52218": {"symbol": "AUBANK28OCT25FUT", "name": "AUBANK", "company": "AU Small Finance Bank Ltd", "weight": 1.11},
-    "52223": {"symbol": "AXISBANK28OCT25FUT", "name": "AXISBANK", "company": "Axis Bank Ltd", "weight": 8.97},
-    "52374": {"symbol": "ICICIBANK28OCT25FUT", "name": "ICICIBANK", "company": "ICICI Bank Ltd", "weight": 25.84},
-    "52380": {"symbol": "IDFCFIRSTB28OCT25FUT", "name": "IDFCFIRSTB", "company": "IDFC First Bank Ltd", "weight": 1.21},
-    "52394": {"symbol": "INDUSINDBK28OCT25FUT", "name": "INDUSINDBK", "company": "IndusInd Bank Ltd", "weight": 1.31},
-    "52514": {"symbol": "SBIN28OCT25FUT", "name": "SBIN", "company": "State Bank of India", "weight": 9.56},
-    "52303": {"symbol": "CANBK28OCT25FUT", "name": "CANBK", "company": "Canara Bank", "weight": 1.13},
-    "52500": {"symbol": "PNB28OCT25FUT", "name": "PNB", "company": "Punjab National Bank", "weight": 1.05},
-    "52364": {"symbol": "HDFCBANK28OCT25FUT", "name": "HDFCBANK", "company": "HDFC Bank Ltd", "weight": 39.1},
-    "52430": {"symbol": "KOTAKBANK28OCT25FUT", "name": "KOTAKBANK", "company": "Kotak Mahindra Bank Ltd", "weight": 8.19},
-}
+class TTLCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL, a size cap and a byte budget.
+    Expired entries are dropped on access and whenever the cache is trimmed;
+    hit/miss/eviction counters are exported through /api/cache-stats.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=None, max_bytes=CACHE_MAX_BYTES):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, expires_at, size, stored_at)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.lock = threading.Lock()
+        CACHES[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.monotonic()
+        size = approx_size(key) + approx_size(value)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (value, now + ttl if ttl is not None else None, size, now)
+            self.bytes += size
+            self._trim(now)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _drop(self, key):
+        value, _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def _trim(self, now):
+        """Drop expired entries, then least recently used ones until within limits"""
+        for key in [key for key, entry in self.entries.items() if entry[1] is not None and entry[1] <= now]:
+            self._drop(key)
+            self.expirations += 1
+        while self.entries and (len(self.entries) > self.maxsize or self.bytes > self.max_bytes):
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'maxsize': self.maxsize,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+    def summary(self, offset=0, limit=50):
+        """Paged entry metadata (never the cached values), least recently used first"""
+        now = time.monotonic()
+        with self.lock:
+            page = list(itertools.islice(self.entries.items(), offset, offset + limit))
+        return {
+            'stats': self.stats(),
+            'offset': offset,
+            'limit': limit,
+            'entries': [{
+                'key': str(key),
+                'bytes': size,
+                'age_seconds': round(now - stored_at, 1),
+                'expires_in': round(expires_at - now, 1) if expires_at is not None else None
+            } for key, (_, expires_at, size, stored_at) in page]
+        }
+
+CACHES = {}  # name -> TTLCache, for /api/cache-stats
+# Idle while get_historical_oi_data is short-circuited; view_cache is the only live user
+historical_oi_cache = TTLCache('historical_oi', maxsize=2000)  # Entries expire at IST midnight
+view_cache = TTLCache('views', maxsize=32, ttl=3600)  # Meters/baskets recomputed for a non-default mode, per snapshot
+
+# ====== INSTRUMENT UNIVERSE ======
+# Index definitions live in data/ (see data/segments.json) so the tracked
+# universe can grow to Nifty 500 / the full F&O list without code changes.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SEGMENTS_FILE = os.environ.get('SEGMENTS_FILE', os.path.join(DATA_DIR, 'segments.json'))
+STATE_DIR = os.environ.get('STATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state'))
+
+INSTRUMENTS = []  # slot -> static instrument metadata, one entry per (exchange, token)
+INSTRUMENT_SLOTS = {}  # (exchange, token) -> slot in INSTRUMENTS
+
+def register_instrument(exchange, token, info):
+    """Add an instrument to the shared instrument table (once per exchange/token) and return its slot"""
+    key = (exchange, token)
+    slot = INSTRUMENT_SLOTS.get(key)
+    if slot is None:
+        slot = len(INSTRUMENTS)
+        INSTRUMENT_SLOTS[key] = slot
+        INSTRUMENTS.append({
+            'slot': slot,
+            'exchange': exchange,
+            'token': token,
+            'symbol': info['symbol'],
+            'name': info['name'],
+            'company': info['company']
+        })
+    return slot
+
+def load_token_map(path, exchange):
+    """Load a {token: {symbol, name, company, weight}} map from an index CSV file"""
+    token_map = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            token = row['token'].strip()
+            info = {
+                'symbol': sys.intern(row['symbol'].strip()),
+                'name': sys.intern(row['name'].strip()),
+                'company': sys.intern(row['company'].strip()),
+                'weight': float(row.get('weight') or 0)
+            }
+            info['slot'] = register_instrument(exchange, token, info)
+            token_map[token] = info
+    return token_map
+
+def load_segments(manifest_path=SEGMENTS_FILE):
+    """Load segment definitions and their token maps from the data manifest"""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    
+    segments = []
+    for definition in manifest['segments']:
+        path = os.path.join(os.path.dirname(manifest_path), definition['file'])
+        if not os.path.exists(path):
+            if definition.get('optional'):
+                print(f"ℹ️ Skipping optional segment {definition['key']} ({definition['file']} not found)")
+                continue
+            raise FileNotFoundError(path)
+        
+        segment = dict(definition)
+        segment['tokens'] = load_token_map(path, definition['exchange'])
+        segments.append(segment)
+        print(f"📋 Loaded {len(segment['tokens'])} instruments for {segment['label']}")
+    return segments
+
+SEGMENTS = load_segments()
+SEGMENTS_BY_KEY = {segment['key']: segment for segment in SEGMENTS}
+SEGMENTS_BY_ROUTE = {segment['route']: segment for segment in SEGMENTS}
+
+# Changes whenever the universe files change; compact responses carry it so
+# clients know when to refetch /api/instruments
+INSTRUMENTS_VERSION = f"{zlib.crc32(json.dumps([INSTRUMENTS, [[s['key'], s['tokens']] for s in SEGMENTS]]).encode()):08x}"
+
+# Nifty 50 / Bank Nifty equity and futures (October 28, 2025 expiry) token maps
+NIFTY_50_STOCKS = SEGMENTS_BY_KEY['nifty_50']['tokens']
+BANK_NIFTY_STOCKS = SEGMENTS_BY_KEY['bank_nifty']['tokens']
+NIFTY_50_FUTURES = SEGMENTS_BY_KEY['nifty_futures']['tokens']
+BANK_NIFTY_FUTURES = SEGMENTS_BY_KEY['bank_futures']['tokens']
 
 def authenticate():
     """Authenticate with Angel One API"""
@@ -378,6 +564,7 @@ def authenticate():
             result = response.json()
             if result.get('status') and result.get('data'):
                 cached_data['auth_token'] = result['data']['jwtToken']
+                cached_data['auth_obtained_at'] = get_ist_time()
                 print("✅ Authentication successful")
                 return True
             else:
@@ -390,102 +577,276 @@ def authenticate():
         print(f"Authentication error: {e}")
         return False
 
-def fetch_market_data(tokens_dict, exchange="NSE"):
-    """Fetch market data for given tokens"""
+# ====== QUOTE FETCH PLAN ======
+QUOTE_BATCH_SIZE = 50  # Angel One quote API accepts up to 50 tokens per request
+QUOTE_RATE_LIMIT = float(os.environ.get('QUOTE_RATE_LIMIT', 10))  # requests per second
+QUOTE_MAX_WORKERS = int(os.environ.get('QUOTE_MAX_WORKERS', 4))
+QUOTE_BATCH_RETRIES = int(os.environ.get('QUOTE_BATCH_RETRIES', 2))
+QUOTE_HEDGE_DELAY = float(os.environ.get('QUOTE_HEDGE_DELAY', 2.0))  # seconds, until latency history exists
+SESSION_EXPIRED_CODES = ('AG8001', 'AG8002', 'AG8003')  # Invalid / expired / missing JWT
+
+class RateLimiter:
+    """Thread-safe token bucket shared by every caller of one upstream API"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+quote_rate_limiter = RateLimiter(QUOTE_RATE_LIMIT)
+quote_latencies = deque(maxlen=100)  # Recent successful batch latencies, for the hedge delay
+hedge_executor = ThreadPoolExecutor(max_workers=QUOTE_MAX_WORKERS * 2, thread_name_prefix='quote-attempt')
+auth_lock = threading.Lock()
+
+def get_api_headers():
+    """Standard Angel One SmartAPI headers for the current session"""
+    return {
+        'Authorization': f'Bearer {cached_data["auth_token"]}',
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+        'X-UserType': 'USER',
+        'X-SourceID': 'WEB',
+        'X-ClientLocalIP': '192.168.1.1',
+        'X-ClientPublicIP': '192.168.1.1',
+        'X-MACAddress': '00:00:00:00:00:00',
+        'X-PrivateKey': API_KEY
+    }
+
+def build_fetch_plan(segments):
+    """
+    Pack every unique (exchange, token) across the given segments into quote
+    batches of QUOTE_BATCH_SIZE. Instruments shared between segments
+    (e.g. HDFCBANK in Nifty 50 and Bank Nifty) are only fetched once, and a
+    batch may mix exchanges.
+    """
+    seen = set()
+    pairs = []
+    for segment in segments:
+        for token in segment['tokens']:
+            key = (segment['exchange'], token)
+            if key not in seen:
+                seen.add(key)
+                pairs.append(key)
+    
+    plan = []
+    for i in range(0, len(pairs), QUOTE_BATCH_SIZE):
+        exchange_tokens = {}
+        for exchange, token in pairs[i:i + QUOTE_BATCH_SIZE]:
+            exchange_tokens.setdefault(exchange, []).append(token)
+        plan.append(exchange_tokens)
+    return plan
+
+def fetch_quote_batch(exchange_tokens):
+    """Quote one packed batch. Returns {(exchange, token): item}, or None if the batch failed."""
+    quote_rate_limiter.acquire()
+    request_data = {
+        "mode": "FULL",
+        "exchangeTokens": exchange_tokens
+    }
+    auth_token = cached_data['auth_token']
+    response = requests.post(MARKET_DATA_URL, json=request_data, headers=get_api_headers(), timeout=30)
+    if response.status_code in (401, 403):
+        renew_session(auth_token)
+        return None
+    if response.status_code != 200:
+        return None
+    
+    result = response.json()
+    if not (result.get('status') and result.get('data')):
+        if result.get('errorcode') in SESSION_EXPIRED_CODES:
+            renew_session(auth_token)
+        return None
+    
+    token_exchange = {token: exchange for exchange, tokens in exchange_tokens.items() for token in tokens}
+    quotes = {}
+    for item in result['data'].get('fetched') or []:
+        # Angel One API now uses 'symbolToken' instead of 'exchToken'
+        if 'symbolToken' not in item:
+            continue
+        token_key = str(item['symbolToken'])  # Convert to string for consistent lookup
+        exchange = item.get('exchange') or token_exchange.get(token_key)
+        quotes[(exchange, token_key)] = item
+    return quotes
+
+def renew_session(stale_token):
+    """Re-login once when the session expires, even if several batches notice it together"""
+    with auth_lock:
+        if cached_data['auth_token'] == stale_token:
+            print("🔑 Session expired, re-authenticating...")
+            authenticate()
+
+def safe_fetch_quote_batch(exchange_tokens):
+    """Quote one batch, turning any exception into a failed batch and recording latency"""
+    started = time.monotonic()
+    try:
+        quotes = fetch_quote_batch(exchange_tokens)
+    except Exception as e:
+        print(f"Error in fetch_quote_batch: {e}")
+        return None
+    if quotes is not None:
+        quote_latencies.append(time.monotonic() - started)
+    return quotes
+
+def get_hedge_delay():
+    """Send a duplicate request once a batch is slower than ~95% of recent batches"""
+    if len(quote_latencies) < 20:
+        return QUOTE_HEDGE_DELAY
+    ordered = sorted(quote_latencies)
+    return max(0.2, ordered[int(len(ordered) * 0.95) - 1])
+
+def hedged_fetch_quote_batch(exchange_tokens):
+    """
+    One attempt at a batch: if the primary request has not answered within
+    the hedge delay, a duplicate is sent and whichever succeeds first wins.
+    Returns (quotes or None, hedged).
+    """
+    primary = hedge_executor.submit(safe_fetch_quote_batch, exchange_tokens)
+    done, _ = wait([primary], timeout=get_hedge_delay())
+    if done:
+        return primary.result(), False
     
+    pending = {primary, hedge_executor.submit(safe_fetch_quote_batch, exchange_tokens)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.result() is not None:
+                return future.result(), True
+    return None, True
+
+def fetch_batch_with_retries(exchange_tokens):
+    """Hedged attempts with exponential backoff. Returns (quotes or None, retries, hedges)."""
+    retries = hedges = 0
+    for attempt in range(QUOTE_BATCH_RETRIES + 1):
+        if attempt:
+            retries += 1
+            time.sleep(0.5 * 2 ** (attempt - 1))
+        quotes, hedged = hedged_fetch_quote_batch(exchange_tokens)
+        hedges += hedged
+        if quotes is not None:
+            return quotes, retries, hedges
+    return None, retries, hedges
+
+def fetch_quotes(plan, health=None):
+    """
+    Execute a fetch plan concurrently under the shared rate limit.
+    Batch outcomes (failures, retries, hedges) are accumulated into health.
+    """
     if not cached_data['auth_token']:
         if not authenticate():
-            return []
+            return {}
     
-    try:
-        headers = {
-            'Authorization': f'Bearer {cached_data["auth_token"]}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'X-UserType': 'USER',
-            'X-SourceID': 'WEB',
-            'X-ClientLocalIP': '192.168.1.1',
-            'X-ClientPublicIP': '192.168.1.1',
-            'X-MACAddress': '00:00:00:00:00:00',
-            'X-PrivateKey': API_KEY
-        }
+    health = health if health is not None else {}
+    quotes = {}
+    with ThreadPoolExecutor(max_workers=QUOTE_MAX_WORKERS) as executor:
+        for exchange_tokens, (batch_quotes, retries, hedges) in zip(plan, executor.map(fetch_batch_with_retries, plan)):
+            health['batches'] = health.get('batches', 0) + 1
+            health['retries'] = health.get('retries', 0) + retries
+            health['hedges'] = health.get('hedges', 0) + hedges
+            if batch_quotes is None:
+                health['failed_batches'] = health.get('failed_batches', 0) + 1
+                print(f"⚠️ Quote batch failed after {retries} retries ({sum(len(t) for t in exchange_tokens.values())} tokens)")
+                continue
+            quotes.update(batch_quotes)
+    return quotes
+
+def build_segment_rows(tokens_dict, exchange, quotes, previous_rows=None, previous_update=None):
+    """
+    Turn raw quotes into dashboard rows for one segment. Instruments missing
+    from this fetch are carried over from previous_rows, flagged as stale
+    with the age of their last good quote.
+    """
+    previous_by_token = {row['token']: row for row in previous_rows or []}
+    now = get_ist_time()
+    if exchange == "NFO":
+        roll_oi_session(now.date())  # So the first fetch of a session measures OI against the last one
+    market_data = []
+    for token_key, stock_info in tokens_dict.items():
+        item = quotes.get((exchange, token_key))
+        if item is None:
+            previous_row = previous_by_token.get(token_key)
+            if previous_row is None:
+                continue
+            as_of = previous_row.get('asOf') or (previous_update.isoformat() if previous_update else None)
+            market_data.append({
+                **previous_row,
+                'stale': True,
+                'asOf': as_of,
+                'ageSeconds': int((now - datetime.fromisoformat(as_of)).total_seconds()) if as_of else None
+            })
+            continue
         
-        market_data = []
-        tokens = list(tokens_dict.keys())
+        # Calculate Net OI Change for futures (NFO exchange)
+        net_oi_change = 0
+        current_oi = int(item.get('opnInterest', 0))
         
-        # Process in batches of 50
-        for i in range(0, len(tokens), 50):
-            batch_tokens = tokens[i:i+50]
-            
-            request_data = {
-                "mode": "FULL",
-                "exchangeTokens": {
-                    exchange: batch_tokens
-                }
-            }
-            
-            response = requests.post(MARKET_DATA_URL, json=request_data, headers=headers, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                
-                if result.get('status') and result.get('data'):
-                    fetched_data = result['data']['fetched']
-                    
-                    for item in fetched_data:
-                        # Angel One API now uses 'symbolToken' instead of 'exchToken'
-                        if 'symbolToken' not in item:
-                            continue
-                            
-                        token_key = str(item['symbolToken'])  # Convert to string for consistent lookup
-                        if token_key in tokens_dict:
-                            stock_info = tokens_dict[token_key]
-                            
-                            # Calculate Net OI Change for futures (NFO exchange)
-                            net_oi_change = 0
-                            current_oi = int(item.get('opnInterest', 0))
-                            
-                            if exchange == "NFO" and current_oi > 0:
-                                # Get historical OI data for futures
-                                previous_oi = get_historical_oi_data(token_key)
-                                
-                                if previous_oi > 0:
-                                    net_oi_change = current_oi - previous_oi
-                                else:
-                                    # Temporary fallback: Use a small percentage of current OI as mock change
-                                    import random
-                                    percentage_change = random.uniform(-0.05, 0.05)  # Random -5% to +5%
-                                    net_oi_change = int(current_oi * percentage_change)
-                            
-                            processed_item = {
-                                'token': token_key,
-                                'symbol': stock_info['symbol'],
-                                'name': stock_info['name'],
-                                'company': stock_info['company'],
-                                'weight': stock_info['weight'],
-                                'ltp': float(item.get('ltp', 0)),
-                                'open': float(item.get('open', 0)),
-                                'high': float(item.get('high', 0)),
-                                'low': float(item.get('low', 0)),
-                                'close': float(item.get('close', 0)),
-                                'netChange': float(item.get('netChange', 0)),
-                                'percentChange': float(item.get('percentChange', 0)),  # Note: now 'percentChange' not 'pChange'
-                                'tradeVolume': int(item.get('tradeVolume', 0)),  # Note: now 'tradeVolume' not 'totVolume'
-                                'netChangeOpnInterest': net_oi_change,  # Use calculated value for futures, 0 for stocks
-                                'opnInterest': current_oi,
-                                'tradingSymbol': item.get('tradingSymbol', stock_info['symbol'])
-                            }
-                            market_data.append(processed_item)
-                        else:
-                            continue
-                else:
-                    continue
-            else:
-                continue
+        if exchange == "NFO" and current_oi > 0:
+            # Get historical OI data for futures, else our own intraday OI series
+            previous_oi = get_historical_oi_data(token_key) or reference_oi(token_key)
             
-            time.sleep(0.5)  # Reduced from 1 second to 0.5 seconds for faster processing
+            if previous_oi > 0:
+                net_oi_change = current_oi - previous_oi
         
-        return market_data
+        market_data.append({
+            'token': token_key,
+            'symbol': stock_info['symbol'],
+            'name': stock_info['name'],
+            'company': stock_info['company'],
+            'weight': stock_info['weight'],
+            'ltp': float(item.get('ltp', 0)),
+            'open': float(item.get('open', 0)),
+            'high': float(item.get('high', 0)),
+            'low': float(item.get('low', 0)),
+            'close': float(item.get('close', 0)),
+            'netChange': float(item.get('netChange', 0)),
+            'percentChange': float(item.get('percentChange', 0)),  # Note: now 'percentChange' not 'pChange'
+            'tradeVolume': int(item.get('tradeVolume', 0)),  # Note: now 'tradeVolume' not 'totVolume'
+            'netChangeOpnInterest': net_oi_change,  # Use calculated value for futures, 0 for stocks
+            'opnInterest': current_oi,
+            'tradingSymbol': item.get('tradingSymbol', stock_info['symbol'])
+        })
+    return market_data
+
+def fetch_all_segments(segments, health=None):
+    """
+    Fetch every segment through one shared, de-duplicated fetch plan.
+    Anything a failed batch missed is filled from the currently published rows,
+    so one bad batch never blanks a segment.
+    """
+    health = health if health is not None else {}
+    plan = build_fetch_plan(segments)
+    started = time.monotonic()
+    quotes = fetch_quotes(plan, health)
+    print(f"📦 Fetched {len(quotes)} quotes in {len(plan)} batches ({time.monotonic() - started:.2f}s)")
+    
+    segment_data = {}
+    for segment in segments:
+        rows = build_segment_rows(
+            segment['tokens'], segment['exchange'], quotes,
+            previous_rows=cached_data.get(segment['key']), previous_update=cached_data.get('last_update')
+        )
+        segment_data[segment['key']] = rows
+        health['filled'] = health.get('filled', 0) + sum(1 for row in rows if row.get('stale'))
+    return segment_data
+
+def fetch_market_data(tokens_dict, exchange="NSE"):
+    """Fetch market data for given tokens"""
+    try:
+        segment = {'key': 'adhoc', 'exchange': exchange, 'tokens': tokens_dict}
+        return fetch_all_segments([segment])['adhoc']
     except Exception as e:
         print(f"Error in fetch_market_data: {e}")
         return []
@@ -536,17 +897,745 @@ def fetch_pcr_data():
         print(f"❌ Error fetching PCR data: {e}")
         return {}
 
-def calculate_meter_value(market_data):
+# ====== DERIVATIVES MASTER ======
+SCRIP_MASTER_URL = "https://margincalculator.angelbroking.com/OpenAPI_File/files/OpenAPIScripMaster.json"
+DERIVATIVES_MASTER_FILE = os.path.join(STATE_DIR, 'nfo_derivatives.json')
+DERIVATIVES_MASTER_RETRY_SECONDS = int(os.environ.get('DERIVATIVES_MASTER_RETRY_SECONDS', 900))  # back-off after a failed download
+
+derivatives_master = {'date': None, 'contracts': {}, 'failed_at': None}  # contracts: name -> list of contract records
+
+def parse_master_contract(item):
+    """Compact contract record from one scrip master entry"""
+    return {
+        'token': str(item['token']),
+        'symbol': item.get('symbol', ''),
+        'type': item.get('instrumenttype', ''),
+        'expiry': datetime.strptime(item['expiry'], '%d%b%Y').date().isoformat(),
+        'strike': float(item.get('strike') or 0) / 100,  # Master strikes are in paise
+        'option_type': item['symbol'][-2:] if item.get('instrumenttype', '').startswith('OPT') else '',
+        'lot_size': int(float(item.get('lotsize') or 0))
+    }
+
+def load_derivatives_master():
     """
-    Calculate institutional-level weighted sentiment meter based on:
-    - Weighted OI Change 
-    - Weighted Price Change
-    - Weighted PCR
-    Following institutional desk methodology
+    NFO futures/options contracts grouped by underlying name.
+    The full scrip master is large, so it is downloaded at most once per day
+    and only the NFO derivatives are kept on disk. A failed download is not
+    retried for DERIVATIVES_MASTER_RETRY_SECONDS; until then the last known
+    contracts (possibly yesterday's) are served.
     """
-    if not market_data:
-        return 0.0
+    today = get_ist_time().date().isoformat()
+    if derivatives_master['date'] == today:
+        return derivatives_master['contracts']
+    failed_at = derivatives_master['failed_at']
+    if failed_at is not None and time.monotonic() - failed_at < DERIVATIVES_MASTER_RETRY_SECONDS:
+        return derivatives_master['contracts']
+    
+    try:
+        with open(DERIVATIVES_MASTER_FILE) as f:
+            stored = json.load(f)
+        if stored.get('date') == today:
+            derivatives_master.update({'date': today, 'contracts': stored['contracts'], 'failed_at': None})
+            return derivatives_master['contracts']
+        if not derivatives_master['contracts']:
+            # Unexpired contracts from an older master stay valid if today's download fails
+            derivatives_master['contracts'] = stored.get('contracts') or {}
+    except (FileNotFoundError, ValueError):
+        pass
+    
+    print("📥 Downloading instrument master...")
+    derivatives_master['failed_at'] = time.monotonic()
+    try:
+        response = requests.get(SCRIP_MASTER_URL, timeout=60)
+        if response.status_code != 200:
+            print(f"❌ Instrument master HTTP Error: {response.status_code} (retry in {DERIVATIVES_MASTER_RETRY_SECONDS}s)")
+            return derivatives_master['contracts']
+        
+        contracts = {}
+        for item in response.json():
+            if item.get('exch_seg') != 'NFO' or item.get('instrumenttype') not in ('FUTSTK', 'FUTIDX', 'OPTSTK', 'OPTIDX'):
+                continue
+            try:
+                contracts.setdefault(item['name'], []).append(parse_master_contract(item))
+            except (KeyError, ValueError):
+                continue
+        
+        derivatives_master.update({'date': today, 'contracts': contracts, 'failed_at': None})
+        atomic_write_json(DERIVATIVES_MASTER_FILE, {'date': today, 'contracts': contracts})
+        print(f"✅ Instrument master loaded: {len(contracts)} underlyings")
+    except Exception as e:
+        print(f"❌ Error loading instrument master: {e} (retry in {DERIVATIVES_MASTER_RETRY_SECONDS}s)")
+    return derivatives_master['contracts']
+
+# ====== OPTION CHAIN ======
+OPTION_CHAIN_ENABLED = os.environ.get('OPTION_CHAIN_ENABLED', 'false').lower() == 'true'
+OPTION_CHAIN_STRIKES = int(os.environ.get('OPTION_CHAIN_STRIKES', 10))  # strikes each side of ATM, 0 = all
+OPTION_CHAIN_WALLS = 3  # Top OI strikes reported as call/put walls
+
+def resolve_option_chain(master, name, spot=None):
+    """
+    Near-expiry CE/PE tokens for one underlying, as parallel arrays sorted by
+    strike. When spot is known the chain is trimmed to OPTION_CHAIN_STRIKES
+    strikes either side of the money.
+    """
+    contracts = master.get(name, [])
+    today = get_ist_time().date().isoformat()
+    options = [c for c in contracts if c['option_type'] in ('CE', 'PE') and c['expiry'] >= today]
+    if not options:
+        return None
+    
+    expiry = min(c['expiry'] for c in options)
+    ce_tokens, pe_tokens = {}, {}
+    for contract in options:
+        if contract['expiry'] == expiry:
+            (ce_tokens if contract['option_type'] == 'CE' else pe_tokens)[contract['strike']] = contract['token']
+    
+    strikes = sorted(set(ce_tokens) | set(pe_tokens))
+    if spot and OPTION_CHAIN_STRIKES:
+        atm = bisect.bisect_left(strikes, spot)
+        strikes = strikes[max(0, atm - OPTION_CHAIN_STRIKES):atm + OPTION_CHAIN_STRIKES]
+    
+    return {
+        'name': name,
+        'expiry': expiry,
+        'strikes': strikes,
+        'ce_tokens': [ce_tokens.get(strike) for strike in strikes],
+        'pe_tokens': [pe_tokens.get(strike) for strike in strikes]
+    }
+
+def compute_max_pain(strikes, ce_oi, pe_oi):
+    """
+    Strike at which option writers lose least, in O(n) over sorted strikes.
+    Writer loss at settlement S is sum(ce_oi * max(0, S - k)) + sum(pe_oi * max(0, k - S));
+    both sums come from running prefix/suffix totals instead of an O(n²) scan.
+    """
+    ce_cum = list(itertools.accumulate(ce_oi))
+    ce_k_cum = list(itertools.accumulate(oi * k for oi, k in zip(ce_oi, strikes)))
+    pe_suffix = list(itertools.accumulate(reversed(pe_oi)))[::-1]
+    pe_k_suffix = list(itertools.accumulate(oi * k for oi, k in zip(reversed(pe_oi), reversed(strikes))))[::-1]
+    
+    losses = [
+        (s * ce_cum[j] - ce_k_cum[j]) + (pe_k_suffix[j] - s * pe_suffix[j])
+        for j, s in enumerate(strikes)
+    ]
+    best = min(range(len(strikes)), key=losses.__getitem__)
+    return strikes[best], losses
+
+def analyse_option_chain(chain, quotes):
+    """PCR, max pain and OI walls for one resolved chain"""
+    def oi_for(token):
+        item = quotes.get(('NFO', token)) if token else None
+        return float(item.get('opnInterest', 0)) if item else 0.0
+    
+    strikes = chain['strikes']
+    ce_oi = array('d', map(oi_for, chain['ce_tokens']))
+    pe_oi = array('d', map(oi_for, chain['pe_tokens']))
+    total_ce, total_pe = sum(ce_oi), sum(pe_oi)
+    if not strikes or total_ce + total_pe == 0:
+        return None
+    
+    max_pain, _ = compute_max_pain(strikes, ce_oi, pe_oi)
+    return {
+        'name': chain['name'],
+        'expiry': chain['expiry'],
+        'pcr': round(total_pe / total_ce, 4) if total_ce else None,
+        'max_pain': max_pain,
+        'total_ce_oi': int(total_ce),
+        'total_pe_oi': int(total_pe),
+        'call_walls': [
+            {'strike': strikes[i], 'oi': int(ce_oi[i])}
+            for i in heapq.nlargest(OPTION_CHAIN_WALLS, range(len(strikes)), key=ce_oi.__getitem__)
+        ],
+        'put_walls': [
+            {'strike': strikes[i], 'oi': int(pe_oi[i])}
+            for i in heapq.nlargest(OPTION_CHAIN_WALLS, range(len(strikes)), key=pe_oi.__getitem__)
+        ],
+        'strikes': [
+            {'strike': strike, 'ce_oi': int(ce), 'pe_oi': int(pe)}
+            for strike, ce, pe in zip(strikes, ce_oi, pe_oi)
+        ]
+    }
+
+def refresh_option_chains(futures_rows, master, health=None):
+    """
+    Resolve and quote the near-expiry chain of every tracked futures
+    underlying in packed batches, and return {name: analysis}.
+    master is this refresh's load_derivatives_master() result.
+    """
+    spots = {}
+    for row in futures_rows:
+        spots.setdefault(row['name'], row['ltp'])
+    
+    chains = [chain for chain in (resolve_option_chain(master, name, spot) for name, spot in spots.items()) if chain]
+    if not chains:
+        return {}
+    
+    option_tokens = {
+        token: None
+        for chain in chains
+        for token in chain['ce_tokens'] + chain['pe_tokens'] if token
+    }
+    plan = build_fetch_plan([{'exchange': 'NFO', 'tokens': option_tokens}])
+    started = time.monotonic()
+    quotes = fetch_quotes(plan, health)
+    print(f"🧾 Option chains: {len(chains)} underlyings, {len(option_tokens)} contracts in {len(plan)} batches ({time.monotonic() - started:.2f}s)")
+    
+    results = {}
+    for chain in chains:
+        analysis = analyse_option_chain(chain, quotes)
+        if analysis:
+            results[chain['name']] = analysis
+    return results
+
+def apply_option_chain_pcr(rows, option_chains):
+    """Feed per-underlying OI PCR into futures rows for calculate_meter_value"""
+    for row in rows or []:
+        chain = option_chains.get(row['name'])
+        if chain and chain['pcr'] is not None:
+            row['pcr'] = chain['pcr']
+
+# ====== FUTURES CURVE ======
+# Near, next and far month futures for every tracked underlying. Quotes are
+# laid out as flat arrays with FUTURES_CURVE_DEPTH slots per underlying, so
+# rollover, combined OI and calendar spreads for all underlyings come from
+# strided slices rather than per-contract bookkeeping.
+MULTI_EXPIRY_ENABLED = os.environ.get('MULTI_EXPIRY_ENABLED', 'false').lower() == 'true'
+FUTURES_CURVE_DEPTH = 3  # near, next, far
+ISS_OI_BASIS = os.environ.get('ISS_OI_BASIS', 'near')  # 'near' month OI or 'combined' across expiries
+
+def resolve_futures_curve(master, name):
+    """Unexpired futures of one underlying, nearest first (at most FUTURES_CURVE_DEPTH)"""
+    today = get_ist_time().date().isoformat()
+    futures = sorted(
+        (c for c in master.get(name, []) if c['type'] in ('FUTSTK', 'FUTIDX') and c['expiry'] >= today),
+        key=lambda contract: contract['expiry']
+    )[:FUTURES_CURVE_DEPTH]
+    if not futures:
+        return None
+    return {
+        'name': name,
+        'expiries': [c['expiry'] for c in futures],
+        'symbols': [c['symbol'] for c in futures],
+        'tokens': [c['token'] for c in futures]
+    }
+
+def analyse_futures_curves(curves, quotes):
+    """
+    Rollover %, combined OI and calendar spreads for every curve at once.
+    Quotes carry no OI change, so each expiry's change is measured against
+    its reference_oi(); it is NaN (reported as None) until one exists, and
+    so is the combined change of any underlying with an unknown expiry.
+    """
+    depth = FUTURES_CURVE_DEPTH
+    size = len(curves) * depth
+    ltp, oi, oi_change = array('d', [0.0]) * size, array('d', [0.0]) * size, array('d', [0.0]) * size
+    for i, curve in enumerate(curves):
+        for j, token in enumerate(curve['tokens']):
+            item = quotes.get(('NFO', token))
+            if item:
+                k = i * depth + j
+                ltp[k] = float(item.get('ltp') or 0)
+                oi[k] = float(item.get('opnInterest') or 0)
+                reference = reference_oi(token)
+                oi_change[k] = oi[k] - reference if reference else math.nan
     
+    # Column j of each strided slice is expiry j of every underlying
+    combined_oi = list(map(math.fsum, zip(*(oi[j::depth] for j in range(depth)))))
+    combined_change = list(map(math.fsum, zip(*(oi_change[j::depth] for j in range(depth)))))
+    near_oi, near_ltp = oi[0::depth], ltp[0::depth]
+    rollover = [(total - near) / total * 100 if total else None for total, near in zip(combined_oi, near_oi)]
+    spreads = [
+        [later - near if later and near else None for near, later in zip(near_ltp, ltp[j::depth])]
+        for j in range(1, depth)
+    ]
+    
+    results = {}
+    for i, curve in enumerate(curves):
+        count = len(curve['tokens'])
+        row_spreads = [spreads[j][i] for j in range(count - 1)]
+        results[curve['name']] = {
+            **curve,
+            'ltp': list(ltp[i * depth:i * depth + count]),
+            'oi': [int(value) for value in oi[i * depth:i * depth + count]],
+            'oi_change': [None if math.isnan(value) else int(value) for value in oi_change[i * depth:i * depth + count]],
+            'combined_oi': int(combined_oi[i]),
+            'combined_oi_change': None if math.isnan(combined_change[i]) else int(combined_change[i]),
+            'rollover_pct': round(rollover[i], 2) if rollover[i] is not None else None,
+            'calendar_spreads': [round(spread, 2) if spread is not None else None for spread in row_spreads],
+            'calendar_spread_pct': [
+                round(spread / near_ltp[i] * 100, 3) if spread is not None else None for spread in row_spreads
+            ]
+        }
+    return results
+
+def refresh_futures_curves(futures_rows, master, health=None):
+    """Resolve and quote every tracked underlying's futures curve in packed batches"""
+    names = list(dict.fromkeys(row['name'] for row in futures_rows))
+    curves = [curve for curve in (resolve_futures_curve(master, name) for name in names) if curve]
+    if not curves:
+        return {}
+    
+    plan = build_fetch_plan([{'exchange': 'NFO', 'tokens': {token: None for curve in curves for token in curve['tokens']}}])
+    started = time.monotonic()
+    quotes = fetch_quotes(plan, health)
+    print(f"📆 Futures curves: {len(curves)} underlyings in {len(plan)} batches ({time.monotonic() - started:.2f}s)")
+    return analyse_futures_curves(curves, quotes)
+
+def apply_futures_curves(rows, futures_curves):
+    """Copy combined OI, rollover and the near/next spread onto futures rows"""
+    for row in rows or []:
+        curve = futures_curves.get(row['name'])
+        if curve and curve['combined_oi']:
+            row['combinedOpnInterest'] = curve['combined_oi']
+            row['combinedNetChangeOpnInterest'] = curve['combined_oi_change']
+            row['rolloverPct'] = curve['rollover_pct']
+            row['calendarSpread'] = curve['calendar_spreads'][0] if curve['calendar_spreads'] else None
+
+# ====== BASIS ======
+# Spot and futures segments describe the same underlyings under different
+# tokens. Each futures segment with a "spot" segment in data/segments.json
+# gets a join index (parallel slot arrays paired by underlying name), built
+# once, so every snapshot's basis is a handful of element-wise passes.
+BASIS_OUTLIER_Z = float(os.environ.get('BASIS_OUTLIER_Z', 2.0))
+BASIS_TOP = 5  # Default premium/discount leaders per segment
+
+def futures_expiry(symbol):
+    """Expiry date encoded in a futures symbol such as RELIANCE28OCT25FUT, or None"""
+    if not symbol.endswith('FUT') or len(symbol) < 10:
+        return None
+    try:
+        return datetime.strptime(symbol[-10:-3], '%d%b%y').date()
+    except ValueError:
+        return None
+
+def build_basis_joins(segments):
+    """Pair every futures contract with its spot instrument by underlying name"""
+    joins = []
+    for segment in segments:
+        spot_segment = SEGMENTS_BY_KEY.get(segment.get('spot'))
+        if segment['exchange'] != 'NFO' or spot_segment is None:
+            continue
+        spot_slots = {info['name']: info['slot'] for info in spot_segment['tokens'].values()}
+        pairs = [(info['name'], spot_slots[info['name']], info['slot'], info['weight'], futures_expiry(info['symbol']))
+                 for info in segment['tokens'].values() if info['name'] in spot_slots]
+        if pairs:
+            names, spot, futures, weights, expiries = map(list, zip(*pairs))
+            joins.append({
+                'key': segment['key'],
+                'route': segment['route'],
+                'spot_key': spot_segment['key'],
+                'names': names,
+                'spot_slots': array('l', spot),
+                'futures_slots': array('l', futures),
+                'weights': array('d', weights),
+                'expiries': expiries
+            })
+    return joins
+
+BASIS_JOINS = build_basis_joins(SEGMENTS)
+
+def finite(value, digits):
+    """Round for JSON, mapping NaN to None"""
+    return None if math.isnan(value) else round(value, digits)
+
+def compute_basis(view, today=None):
+    """
+    Per-stock basis, annualised carry and weighted index basis for every
+    joined segment. stocks is ordered by basis %, highest first, so the
+    premium/discount leaders are its two ends.
+    """
+    today = today or get_ist_time().date()
+    ltp = array('d', [math.nan]) * len(INSTRUMENTS)
+    for segment in SEGMENTS:
+        for row in view.get(segment['key']) or []:
+            if not row.get('stale') and row.get('ltp'):
+                ltp[INSTRUMENT_SLOTS[(segment['exchange'], row['token'])]] = row['ltp']
+    
+    results = {}
+    for join in BASIS_JOINS:
+        spot = array('d', map(ltp.__getitem__, join['spot_slots']))
+        futures = array('d', map(ltp.__getitem__, join['futures_slots']))
+        basis = array('d', map(operator.sub, futures, spot))
+        basis_pct = array('d', (b / s * 100 for b, s in zip(basis, spot)))
+        days = array('d', ((expiry - today).days if expiry and expiry >= today else math.nan for expiry in join['expiries']))
+        carry = array('d', (p * 365 / max(d, 1) for p, d in zip(basis_pct, days)))
+        
+        valid = [i for i, p in enumerate(basis_pct) if not math.isnan(p)]
+        if not valid:
+            continue
+        weights = [join['weights'][i] for i in valid]
+        total_weight = math.fsum(weights) or len(valid)
+        index_basis = math.fsum(w * basis_pct[i] for w, i in zip(weights, valid)) / total_weight
+        carried = [i for i in valid if not math.isnan(carry[i])]
+        carry_weight = math.fsum(join['weights'][i] for i in carried)
+        index_carry = math.fsum(join['weights'][i] * carry[i] for i in carried) / carry_weight if carry_weight else math.nan
+        
+        mean = math.fsum(basis_pct[i] for i in valid) / len(valid)
+        std = math.sqrt(math.fsum((basis_pct[i] - mean) ** 2 for i in valid) / len(valid))
+        
+        def pair(i):
+            return {
+                'name': join['names'][i],
+                'spot_token': INSTRUMENTS[join['spot_slots'][i]]['token'],
+                'futures_token': INSTRUMENTS[join['futures_slots'][i]]['token'],
+                'futures_symbol': INSTRUMENTS[join['futures_slots'][i]]['symbol'],
+                'spot': finite(spot[i], 2),
+                'futures': finite(futures[i], 2),
+                'basis': finite(basis[i], 2),
+                'basis_pct': finite(basis_pct[i], 3),
+                'days_to_expiry': None if math.isnan(days[i]) else int(days[i]),
+                'carry_pct': finite(carry[i], 2),
+                'zscore': round((basis_pct[i] - mean) / std, 2) if std else 0.0
+            }
+        
+        results[join['route']] = {
+            'spot_segment': SEGMENTS_BY_KEY[join['spot_key']]['route'],
+            'pairs': len(valid),
+            'index_basis_pct': round(index_basis, 3),
+            'index_carry_pct': finite(index_carry, 2),
+            'mean_basis_pct': round(mean, 3),
+            'std_basis_pct': round(std, 3),
+            'outliers': [pair(i) for i in valid if std and abs(basis_pct[i] - mean) / std > BASIS_OUTLIER_Z],
+            'stocks': [pair(i) for i in sorted(valid, key=basis_pct.__getitem__, reverse=True)]
+        }
+    return results
+
+# ====== CANDLE STORE ======
+# Intraday candles from the historical API, persisted one file per
+# (exchange, token, interval, day) as packed fixed-size records, so a window
+# is located by bisecting a memory-mapped file. Finished days are final
+# (.bin); the current session is kept as .partial and topped up from its last
+# candle, so only missing ranges are ever requested.
+CANDLE_URL = "https://apiconnect.angelone.in/rest/secure/angelbroking/historical/v1/getCandleData"
+CANDLE_DIR = os.path.join(STATE_DIR, 'candles')
+CANDLE_RATE_LIMIT = float(os.environ.get('CANDLE_RATE_LIMIT', 3))  # Historical API allows ~3 requests/second
+CANDLE_MAX_WINDOW_DAYS = 30  # Largest date range one /api/candles request may cover
+CANDLE_INTERVALS = {  # interval -> max days per historical API request
+    'ONE_MINUTE': 30, 'THREE_MINUTE': 60, 'FIVE_MINUTE': 100, 'TEN_MINUTE': 100,
+    'FIFTEEN_MINUTE': 200, 'THIRTY_MINUTE': 200, 'ONE_HOUR': 400, 'ONE_DAY': 2000
+}
+CANDLE_RECORD = struct.Struct('<q4dq')  # epoch seconds, open, high, low, close, volume
+CANDLE_FIELDS = ['time', 'open', 'high', 'low', 'close', 'volume']
+
+candle_rate_limiter = RateLimiter(CANDLE_RATE_LIMIT)
+candle_locks = {}  # {(exchange, token, interval): Lock} so each series is filled by one caller at a time
+candle_locks_guard = threading.Lock()
+candle_prefetch = {'running': False, 'interval': None, 'total': 0, 'done': 0, 'failed': 0}
+
+def candle_path(exchange, token, interval, day, partial=False):
+    """File holding one instrument's candles for one day"""
+    return os.path.join(CANDLE_DIR, interval, day.isoformat(), f"{exchange}_{token}.{'partial' if partial else 'bin'}")
+
+def candle_day_complete(day, now):
+    """True once a day's session is over and its candles can no longer change"""
+    return day < now.date() or now >= session_datetime(day, SESSION_CLOSE) + CLOSING_SNAPSHOT_DELAY
+
+def read_candle_file(path, start=None, end=None):
+    """Candle records in [start, end) epoch seconds, found by bisection over the mmapped file"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < CANDLE_RECORD.size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = len(mm) // CANDLE_RECORD.size
+            def timestamp_at(i):
+                return struct.unpack_from('<q', mm, i * CANDLE_RECORD.size)[0]
+            first = bisect.bisect_left(range(count), start, key=timestamp_at) if start is not None else 0
+            last = bisect.bisect_left(range(count), end, key=timestamp_at) if end is not None else count
+            return list(CANDLE_RECORD.iter_unpack(mm[first * CANDLE_RECORD.size:last * CANDLE_RECORD.size]))
+
+def write_candle_file(path, records):
+    """Atomically write sorted candle records"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(CANDLE_RECORD.pack(*record) for record in records))
+    os.replace(tmp_path, path)
+
+def fetch_candle_range(exchange, token, interval, start, end):
+    """
+    Candles for [start, end] from the historical API as records.
+    Returns None if the request failed.
+    """
+    candle_rate_limiter.acquire()
+    auth_token = cached_data['auth_token']
+    payload = {
+        "exchange": exchange,
+        "symboltoken": token,
+        "interval": interval,
+        "fromdate": start.strftime('%Y-%m-%d %H:%M'),
+        "todate": end.strftime('%Y-%m-%d %H:%M')
+    }
+    try:
+        response = requests.post(CANDLE_URL, json=payload, headers=get_api_headers(), timeout=30)
+    except Exception as e:
+        print(f"Error fetching candles for {exchange}:{token}: {e}")
+        return None
+    if response.status_code in (401, 403):
+        renew_session(auth_token)
+        return None
+    if response.status_code != 200:
+        return None
+    
+    result = response.json()
+    if not result.get('status'):
+        if result.get('errorcode') in SESSION_EXPIRED_CODES:
+            renew_session(auth_token)
+        return None
+    
+    # Each candle is [timestamp, open, high, low, close, volume]
+    return [
+        (int(datetime.fromisoformat(candle[0]).timestamp()), float(candle[1]), float(candle[2]),
+         float(candle[3]), float(candle[4]), int(candle[5]))
+        for candle in result.get('data') or []
+    ]
+
+def candle_gaps(exchange, token, interval, days, now):
+    """
+    Ranges still missing from the store as (start, end, days) tuples.
+    Consecutive missing days are merged into one request (up to the
+    interval's per-request limit); a partial day resumes from its last candle.
+    """
+    gaps = []
+    run = []
+    
+    def close_run():
+        for i in range(0, len(run), CANDLE_INTERVALS[interval]):
+            chunk = run[i:i + CANDLE_INTERVALS[interval]]
+            gaps.append((session_datetime(chunk[0], SESSION_OPEN),
+                         min(session_datetime(chunk[-1], SESSION_CLOSE), now), chunk))
+        run.clear()
+    
+    for day in days:
+        if not is_trading_day(day) or os.path.exists(candle_path(exchange, token, interval, day)):
+            close_run()
+            continue
+        if now < session_datetime(day, SESSION_OPEN):
+            close_run()
+            continue
+        partial = candle_path(exchange, token, interval, day, partial=True)
+        if os.path.exists(partial):
+            close_run()
+            existing = read_candle_file(partial)
+            # The last stored candle may still have been forming, so refetch it
+            start = datetime.fromtimestamp(existing[-1][0], now.tzinfo) if existing else session_datetime(day, SESSION_OPEN)
+            gaps.append((start, min(session_datetime(day, SESSION_CLOSE), now), [day]))
+        else:
+            run.append(day)
+    close_run()
+    return gaps
+
+def fill_candle_gaps(exchange, token, interval, days, now=None):
+    """Fetch whatever is missing for these days and persist it. Returns the days that could not be fetched."""
+    now = now or get_ist_time()
+    with candle_locks_guard:
+        lock = candle_locks.setdefault((exchange, token, interval), threading.Lock())
+    
+    failed = []
+    with lock:
+        for start, end, gap_days in candle_gaps(exchange, token, interval, days, now):
+            records = fetch_candle_range(exchange, token, interval, start, end)
+            if records is None:
+                failed.extend(gap_days)
+                continue
+            first_fetched = int(start.timestamp())
+            for day in gap_days:
+                day_start = int(session_datetime(day, dt_time(0, 0)).timestamp())
+                day_records = [record for record in records if day_start <= record[0] < day_start + 86400]
+                partial = candle_path(exchange, token, interval, day, partial=True)
+                if os.path.exists(partial):
+                    day_records = read_candle_file(partial, end=first_fetched) + day_records
+                if candle_day_complete(day, now):
+                    write_candle_file(candle_path(exchange, token, interval, day), day_records)
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                else:
+                    write_candle_file(partial, day_records)
+    return failed
+
+def get_candles(exchange, token, interval, first_day, last_day, now=None):
+    """Candles for a date range, filling gaps first. Returns (records, days that could not be fetched)."""
+    days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    failed = fill_candle_gaps(exchange, token, interval, days, now)
+    records = []
+    for day in days:
+        for path in (candle_path(exchange, token, interval, day), candle_path(exchange, token, interval, day, partial=True)):
+            if os.path.exists(path):
+                records.extend(read_candle_file(path))
+                break
+    return records, failed
+
+def prefetch_candles(interval, day):
+    """Fill one day of candles for every tracked instrument, several series at a time under the rate limit"""
+    candle_prefetch.update({'running': True, 'interval': interval, 'total': len(INSTRUMENTS), 'done': 0, 'failed': 0})
+    try:
+        with ThreadPoolExecutor(max_workers=QUOTE_MAX_WORKERS, thread_name_prefix='candle-prefetch') as executor:
+            futures = [
+                executor.submit(fill_candle_gaps, instrument['exchange'], instrument['token'], interval, [day])
+                for instrument in INSTRUMENTS
+            ]
+            for future in futures:
+                try:
+                    failed = future.result()
+                except Exception as e:
+                    print(f"Error prefetching candles: {e}")
+                    failed = [day]
+                candle_prefetch['failed' if failed else 'done'] += 1
+        print(f"🕯️ Candle prefetch {interval} {day}: {candle_prefetch['done']} done, {candle_prefetch['failed']} failed")
+    finally:
+        candle_prefetch['running'] = False
+
+# ====== ADAPTIVE ISS NORMALISATION ======
+ISS_STATS_FILE = os.path.join(STATE_DIR, 'iss_stats.json')
+ISS_MODES = ('fixed', 'adaptive')
+ISS_NORMALIZATION_MODE = os.environ.get('ISS_NORMALIZATION_MODE', 'fixed')  # 'fixed' or 'adaptive'
+ISS_STATS_HALFLIFE = float(os.environ.get('ISS_STATS_HALFLIFE', 30))  # in snapshots
+ISS_MIN_SAMPLES = 10  # Below this the adaptive mode falls back to fixed constants
+ISS_Z_RANGE = 2.0  # z = -2 → 0, z = +2 → 1
+ISS_COMPONENTS = ('price', 'oi', 'pcr')
+
+def atomic_write_json(path, payload):
+    """Write JSON to disk atomically (temp file + rename) so readers never see a partial file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+class RollingStats:
+    """
+    O(1) online statistics for one ISS component.
+    Keeps a lifetime mean/variance (Welford) and an exponentially weighted
+    mean/variance so the adaptive mode follows the current market regime.
+    """
+    __slots__ = ('count', 'mean', 'm2', 'ewma_mean', 'ewma_var')
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, ewma_mean=0.0, ewma_var=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.ewma_mean = ewma_mean
+        self.ewma_var = ewma_var
+
+    def update(self, value, alpha):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        if self.count == 1:
+            self.ewma_mean = value
+            self.ewma_var = 0.0
+        else:
+            ewma_delta = value - self.ewma_mean
+            self.ewma_mean += alpha * ewma_delta
+            self.ewma_var = (1 - alpha) * (self.ewma_var + alpha * ewma_delta * ewma_delta)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def zscore(self, value):
+        """Z-score against the EWMA regime, falling back to lifetime variance early on"""
+        std = self.ewma_var ** 0.5 or self.variance ** 0.5
+        if std <= 1e-9:
+            return 0.0
+        return (value - self.ewma_mean) / std
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{slot: data.get(slot, 0) for slot in cls.__slots__})
+
+iss_stats = {}  # {index_key: {component: RollingStats}}
+
+def load_iss_stats():
+    """Load persisted ISS component statistics so adaptive mode survives restarts"""
+    try:
+        with open(ISS_STATS_FILE) as f:
+            raw = json.load(f)
+        for index_key, components in raw.items():
+            iss_stats[index_key] = {
+                name: RollingStats.from_dict(values) for name, values in components.items()
+            }
+        print(f"📂 Loaded ISS statistics for {len(iss_stats)} indices")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Could not load ISS statistics: {e}")
+
+def save_iss_stats():
+    """Persist ISS component statistics"""
+    try:
+        atomic_write_json(ISS_STATS_FILE, {
+            index_key: {name: stats.to_dict() for name, stats in components.items()}
+            for index_key, components in iss_stats.items()
+        })
+    except Exception as e:
+        print(f"⚠️ Could not save ISS statistics: {e}")
+
+def update_iss_stats(index_key, market_data):
+    """Fold one snapshot's ISS components into the rolling statistics (O(1) per component)"""
+    update_component_stats(index_key, calculate_meter_components(market_data))
+
+def update_component_stats(index_key, components):
+    """Fold already-weighted ISS components into the rolling statistics for index_key"""
+    if not components:
+        return
+
+    alpha = 1 - 0.5 ** (1 / ISS_STATS_HALFLIFE)
+    index_stats = iss_stats.setdefault(index_key, {name: RollingStats() for name in ISS_COMPONENTS})
+    for name in ISS_COMPONENTS:
+        index_stats.setdefault(name, RollingStats()).update(components[name], alpha)
+
+def instrument_components(stock):
+    """Unweighted (price change %, OI change %, PCR) ISS inputs for one instrument"""
+    price_change = stock.get('percentChange', 0.0)
+    
+    # Get OI change (actual field from Angel One API), optionally summed over all expiries
+    # once every expiry's change is known
+    if ISS_OI_BASIS == 'combined' and stock.get('combinedOpnInterest') and stock.get('combinedNetChangeOpnInterest') is not None:
+        net_oi_change = stock['combinedNetChangeOpnInterest']
+        current_oi = stock['combinedOpnInterest']
+    else:
+        net_oi_change = stock.get('netChangeOpnInterest', 0)
+        current_oi = stock.get('opnInterest', 0)
+    
+    # Calculate OI change percentage
+    if current_oi > 0 and net_oi_change != 0:
+        oi_change = (net_oi_change / current_oi) * 100
+    else:
+        # For stocks (NSE), use volume change as OI proxy
+        volume = stock.get('tradeVolume', 0)
+        if volume > 0:
+            # Use volume intensity relative to market cap as proxy
+            # Higher volume relative to normal indicates institutional interest
+            volume_intensity = volume / 100000  # Normalize volume
+            # Volume combined with price movement gives directional OI proxy
+            oi_change = volume_intensity * (price_change / 10) if price_change != 0 else 0
+        else:
+            oi_change = 0
+    
+    # Calculate PCR proxy (simplified for futures)
+    # In real implementation, you'd get actual PCR data per stock
+    pcr = stock.get('pcr', 1.0)
+    if pcr == 1.0:  # Default PCR calculation if not available
+        if price_change > 0:
+            pcr = 1.1 + (price_change / 100)  # Higher PCR on price rise
+        else:
+            pcr = 0.9 + (price_change / 100)  # Lower PCR on price fall
+    
+    return price_change, oi_change, pcr
+
+def calculate_meter_components(market_data):
+    """
+    Weighted price change, OI change and PCR for a basket of instruments.
+    Returns None when there is nothing to weigh.
+    """
+    if not market_data:
+        return None
+
     weighted_price_change = 0.0
     weighted_oi_change = 0.0
     weighted_pcr = 0.0
@@ -554,36 +1643,7 @@ def calculate_meter_value(market_data):
     
     for stock in market_data:
         weight = stock.get('weight', 0.0)
-        price_change = stock.get('percentChange', 0.0)
-        
-        # Get OI change (actual field from Angel One API)
-        net_oi_change = stock.get('netChangeOpnInterest', 0)
-        current_oi = stock.get('opnInterest', 0)
-        
-        # Calculate OI change percentage
-        if current_oi > 0 and net_oi_change != 0:
-            oi_change = (net_oi_change / current_oi) * 100
-        else:
-            # For stocks (NSE), use volume change as OI proxy
-            volume = stock.get('tradeVolume', 0)
-            if volume > 0:
-                # Use volume intensity relative to market cap as proxy
-                # Higher volume relative to normal indicates institutional interest
-                volume_intensity = volume / 100000  # Normalize volume
-                price_change = stock.get('percentChange', 0.0)
-                # Volume combined with price movement gives directional OI proxy
-                oi_change = volume_intensity * (price_change / 10) if price_change != 0 else 0
-            else:
-                oi_change = 0
-        
-        # Calculate PCR proxy (simplified for futures)
-        # In real implementation, you'd get actual PCR data per stock
-        pcr = stock.get('pcr', 1.0)
-        if pcr == 1.0:  # Default PCR calculation if not available
-            if price_change > 0:
-                pcr = 1.1 + (price_change / 100)  # Higher PCR on price rise
-            else:
-                pcr = 0.9 + (price_change / 100)  # Lower PCR on price fall
+        price_change, oi_change, pcr = instrument_components(stock)
         
         # Apply weights
         weighted_price_change += weight * price_change
@@ -592,15 +1652,18 @@ def calculate_meter_value(market_data):
         total_weight += weight
     
     if total_weight == 0:
-        return 0.0
+        return None
     
     # Normalize by total weight
-    avg_price_change = weighted_price_change / total_weight
-    avg_oi_change = weighted_oi_change / total_weight
-    avg_pcr = weighted_pcr / total_weight
-    
-    # 🧮 NORMALIZE EACH COMPONENT TO 0-1 SCALE (Institutional Method)
-    
+    return {
+        'price': weighted_price_change / total_weight,
+        'oi': weighted_oi_change / total_weight,
+        'pcr': weighted_pcr / total_weight,
+        'total_weight': total_weight
+    }
+
+def normalize_fixed(avg_price_change, avg_oi_change, avg_pcr):
+    """Normalize ISS components with the fixed institutional constants"""
     # Normalize OI Change: -5% → 0, +5% → 1
     norm_oi = (avg_oi_change + 5) / 10
     norm_oi = max(0, min(1, norm_oi))  # Clip between 0-1
@@ -613,79 +1676,1340 @@ def calculate_meter_value(market_data):
     norm_pcr = (avg_pcr - 0.5) / 1
     norm_pcr = max(0, min(1, norm_pcr))  # Clip between 0-1
     
+    return norm_price, norm_oi, norm_pcr
+
+def normalize_adaptive(index_key, avg_price_change, avg_oi_change, avg_pcr):
+    """
+    Normalize ISS components by their rolling z-score for this index.
+    Returns None until enough snapshots have been observed.
+    """
+    index_stats = iss_stats.get(index_key)
+    if not index_stats or any(index_stats[name].count < ISS_MIN_SAMPLES for name in ISS_COMPONENTS):
+        return None
+    
+    normalized = []
+    for name, value in zip(ISS_COMPONENTS, (avg_price_change, avg_oi_change, avg_pcr)):
+        z = index_stats[name].zscore(value)
+        normalized.append(max(0, min(1, 0.5 + z / (2 * ISS_Z_RANGE))))
+    return tuple(normalized)
+
+def calculate_meter_value(market_data, mode=None, index_key=None):
+    """
+    Calculate institutional-level weighted sentiment meter based on:
+    - Weighted OI Change 
+    - Weighted Price Change
+    - Weighted PCR
+    Following institutional desk methodology.
+    
+    mode='adaptive' normalizes each component by its rolling z-score for
+    index_key instead of the fixed constants. Returns (iss_score, mode
+    actually used), since adaptive falls back to fixed until warmed up.
+    """
+    components = calculate_meter_components(market_data)
+    if not components:
+        return 0.0, 'fixed'
+    
+    avg_price_change = components['price']
+    avg_oi_change = components['oi']
+    avg_pcr = components['pcr']
+    total_weight = components['total_weight']
+    
+    iss_score, mode, (norm_price, norm_oi, norm_pcr) = score_meter_components(components, mode, index_key)
+    
+    print(f"🧠 Institutional Sentiment Score (ISS) Calculation ({mode}):")
+    print(f"   📊 Weighted Price Change: {avg_price_change:.3f}% → Normalized: {norm_price:.3f}")
+    print(f"   📈 Weighted OI Change: {avg_oi_change:.3f}% → Normalized: {norm_oi:.3f}") 
+    print(f"   🎯 Weighted PCR: {avg_pcr:.3f} → Normalized: {norm_pcr:.3f}")
+    print(f"   🏆 ISS Score: (0.4×{norm_price:.3f}) + (0.4×{norm_oi:.3f}) + (0.2×{norm_pcr:.3f}) = {iss_score:.3f}")
+    print(f"   📋 Processed {len(market_data)} instruments with total weight: {total_weight:.2f}")
+    
+    # Debug: Show individual OI changes for top 5 stocks
+    oi_debug = []
+    for stock in market_data[:5]:
+        net_oi = stock.get('netChangeOpnInterest', 0)
+        curr_oi = stock.get('opnInterest', 0)
+        oi_pct = (net_oi / curr_oi * 100) if curr_oi > 0 else 0
+        oi_debug.append(f"{stock.get('symbol', 'N/A')}: {net_oi:,} ({oi_pct:.2f}%)")
+    print(f"   🔍 Sample OI Changes: {', '.join(oi_debug)}")
+    
+    return iss_score, mode
+
+def score_meter_components(components, mode=None, index_key=None):
+    """
+    Normalize weighted ISS components and combine them into a 0-1 score.
+    Returns (iss_score, mode actually used, normalized components).
+    """
+    avg_price_change = components['price']
+    avg_oi_change = components['oi']
+    avg_pcr = components['pcr']
+    
+    # 🧮 NORMALIZE EACH COMPONENT TO 0-1 SCALE (Institutional Method)
+    mode = mode or ISS_NORMALIZATION_MODE
+    normalized = None
+    if mode == 'adaptive' and index_key:
+        normalized = normalize_adaptive(index_key, avg_price_change, avg_oi_change, avg_pcr)
+    if normalized is None:
+        mode = 'fixed'
+        normalized = normalize_fixed(avg_price_change, avg_oi_change, avg_pcr)
+    norm_price, norm_oi, norm_pcr = normalized
+    
     # 📈 INSTITUTIONAL SENTIMENT SCORE (ISS)
     # Weights: Price 40%, OI 40%, PCR 20%
     iss_score = (0.4 * norm_price) + (0.4 * norm_oi) + (0.2 * norm_pcr)
     
     # Ensure ISS stays in 0-1 range
-    iss_score = max(0, min(1, iss_score))
+    return max(0, min(1, iss_score)), mode, normalized
+
+def get_meter_status(iss_score):
+    """Get meter status, color, and trading action based on ISS (0-1 scale)"""
+    if 0.75 <= iss_score <= 1.00:
+        return {
+            "status": "Strong Bullish", 
+            "color": "success", 
+            "icon": "�",
+            "action": "🚀 Go Long (Calls / Futures Buy / BTST Calls)",
+            "trade_type": "Long buildup, heavy long positions",
+            "confidence": "� Strong"
+        }
+    elif 0.60 <= iss_score < 0.75:
+        return {
+            "status": "Mild Bullish", 
+            "color": "info", 
+            "icon": "⚡",
+            "action": "📈 Buy on dips, avoid shorts",
+            "trade_type": "Possible intraday uptrend continuation",
+            "confidence": "⚡ Mild"
+        }
+    elif 0.40 <= iss_score < 0.60:
+        return {
+            "status": "Neutral", 
+            "color": "secondary", 
+            "icon": "⚖️",
+            "action": "⚖️ Avoid directional trades; scalp both sides",
+            "trade_type": "Uncertain / consolidation",
+            "confidence": "⚖️ Neutral"
+        }
+    elif 0.25 <= iss_score < 0.40:
+        return {
+            "status": "Mild Bearish", 
+            "color": "warning", 
+            "icon": "🧊",
+            "action": "📉 Sell on rise, avoid longs",
+            "trade_type": "Short buildup signals forming",
+            "confidence": "🧊 Mild"
+        }
+    else:  # 0.00 <= iss_score < 0.25
+        return {
+            "status": "Strong Bearish", 
+            "color": "danger", 
+            "icon": "❄️",
+            "action": "💣 Go Short (Puts / Futures Sell / BTST Puts)",
+            "trade_type": "Heavy shorts or profit booking",
+            "confidence": "❄️ Strong"
+        }
+
+METER_STATUSES = tuple(get_meter_status(score)['status'] for score in (1.0, 0.7, 0.5, 0.3, 0.0))
+
+# ====== REFRESH CYCLE ======
+CHART_HISTORY_POINTS = 100
+REFRESH_FRESHNESS_SECONDS = float(os.getenv('REFRESH_FRESHNESS_SECONDS', '60'))
+REFRESH_MAX_JOINERS = int(os.environ.get('REFRESH_MAX_JOINERS', 2))  # callers allowed to block on an in-flight cycle
+
+# Single-flight state: one upstream cycle at a time, shared by every caller
+refresh_lock = threading.Lock()
+refresh_in_flight = None
+refresh_joiners = 0
+last_refresh = {'finished_at': None, 'result': None, 'failed_at': None}
+
+def coalesced_refresh(force=False):
+    """
+    Run a refresh cycle or share one. Callers arriving while a cycle is in
+    flight wait for it and get its result; a cycle that finished less than
+    REFRESH_FRESHNESS_SECONDS ago is reused unless force is set.
+    Returns (segment_data, shared). segment_data is None when
+    REFRESH_MAX_JOINERS callers are already waiting: each waiter holds a
+    worker thread, so later callers are answered without blocking.
+    """
+    global refresh_in_flight, refresh_joiners
+    with refresh_lock:
+        flight = refresh_in_flight
+        if flight is None:
+            finished_at = last_refresh['finished_at']
+            if not force and finished_at is not None and time.monotonic() - finished_at < REFRESH_FRESHNESS_SECONDS:
+                return last_refresh['result'], True
+            flight = refresh_in_flight = {'done': threading.Event(), 'result': None, 'error': None}
+            leader = True
+        elif refresh_joiners >= REFRESH_MAX_JOINERS:
+            return None, True
+        else:
+            refresh_joiners += 1
+            leader = False
+    
+    if not leader:
+        print("🔗 Joining in-flight refresh")
+        try:
+            flight['done'].wait()
+        finally:
+            with refresh_lock:
+                refresh_joiners -= 1
+        if flight['error']:
+            raise flight['error']
+        return flight['result'], True
+    
+    try:
+        flight['result'] = run_refresh_cycle()
+        last_refresh.update({'finished_at': time.monotonic(), 'result': flight['result'], 'failed_at': None})
+    except Exception as e:
+        flight['error'] = e
+        last_refresh['failed_at'] = time.monotonic()
+        raise
+    finally:
+        with refresh_lock:
+            refresh_in_flight = None
+        flight['done'].set()
+    return flight['result'], False
+
+def run_refresh_cycle():
+    """Fetch every segment upstream and publish the result as a new snapshot"""
+    if not cached_data.get('auth_token'):
+        print("🔑 Authenticating...")
+        if not authenticate():
+            raise RuntimeError('Authentication failed')
+    
+    # Fetch all segments through one packed fetch plan
+    print("📊 Fetching market data...")
+    health = {}
+    segment_data = fetch_all_segments(SEGMENTS, health)
+    pcr_data = fetch_pcr_data() or cached_data.get('pcr_data') or {}
+    
+    futures_rows = [row for segment in SEGMENTS if segment['exchange'] == 'NFO' for row in segment_data[segment['key']]]
+    # One scrip master lookup per cycle, shared by every underlying
+    master = load_derivatives_master() if OPTION_CHAIN_ENABLED or MULTI_EXPIRY_ENABLED else {}
+    
+    # Real OI-based PCR per underlying from the near-expiry option chains
+    option_chains = cached_data['option_chains']
+    if OPTION_CHAIN_ENABLED:
+        option_chains = refresh_option_chains(futures_rows, master, health)
+        apply_option_chain_pcr(futures_rows, option_chains)
+    
+    # Near/next/far month OI so the meter survives rollover week
+    futures_curves = cached_data['futures_curves']
+    if MULTI_EXPIRY_ENABLED:
+        futures_curves = refresh_futures_curves(futures_rows, master, health)
+        apply_futures_curves(futures_rows, futures_curves)
+    
+    publish_snapshot(segment_data, pcr_data, option_chains, health, futures_curves)
+    return segment_data
+
+def publish_snapshot(segment_data, pcr_data, option_chains, fetch_health=None, futures_curves=None):
+    """
+    Swap a freshly fetched snapshot into cached_data. Meters and chart history
+    are computed once here, and everything is applied in a single
+    cached_data.update() so readers never see a half-published snapshot.
+    """
+    now = get_ist_time()
+    
+    record_oi_series(segment_data, now)
+    if MULTI_EXPIRY_ENABLED:
+        record_curve_series(futures_curves, now)
+    for segment in SEGMENTS:
+        if segment['exchange'] == 'NFO':
+            apply_oi_metrics(segment_data[segment['key']])
+    
+    # Fold this snapshot into the adaptive ISS statistics before scoring it
+    for segment in SEGMENTS:
+        if segment['exchange'] == 'NFO':
+            update_iss_stats(segment['key'], segment_data[segment['key']])
+    columns = snapshot_component_columns(segment_data)
+    baskets = evaluate_baskets(segment_data, update_stats=True, columns=columns)
+    save_iss_stats()
+    
+    meters = compute_meters(segment_data)
+    basis = compute_basis(segment_data, now.date())
+    chart_data = cached_data['chart_data']
+    if segment_data.get('nifty_futures') and segment_data.get('bank_futures'):
+        chart_data = append_chart_point(chart_data, meters, now)
+    
+    cached_data.update({
+        **segment_data,
+        'fetch_health': fetch_health or {},
+        'pcr_data': pcr_data,
+        'option_chains': option_chains,
+        'futures_curves': futures_curves or {},
+        'meters': meters,
+        'baskets': baskets,
+        'basis': basis,
+        'chart_data': chart_data,
+        'last_update': now,
+        'snapshot_version': cached_data['snapshot_version'] + 1,
+        'stale': False
+    })
+    
+    check_alerts(segment_data, meters, baskets, columns)
+    save_snapshot()
+    append_journal()
+
+def build_meter(rows, mode=None, index_key=None):
+    """ISS value plus its status/action fields for one futures basket"""
+    value, used_mode = calculate_meter_value(rows, mode, index_key) if rows else (0, 'fixed')
+    return {'value': round(value, 3), 'mode': used_mode, **get_meter_status(value)}
+
+def compute_meters(view, mode=None):
+    """ISS meter for every futures segment of a snapshot, keyed by segment"""
+    return {
+        segment['key']: build_meter(view.get(segment['key']), mode, segment['key'])
+        for segment in SEGMENTS if segment['exchange'] == 'NFO'
+    }
+
+def meter_status(meter):
+    """Status/action fields of a meter without its value or normalisation mode"""
+    return {key: value for key, value in meter.items() if key not in ('value', 'mode')}
+
+def append_chart_point(chart_data, meters, at):
+    """New chart history with this snapshot's meters appended (last CHART_HISTORY_POINTS kept)"""
+    chart_point = {
+        'timestamp': at.strftime('%H:%M'),
+        'time_full': at.strftime('%Y-%m-%d %H:%M:%S'),
+        'nifty_meter': meters['nifty_futures']['value'],
+        'bank_meter': meters['bank_futures']['value'],
+        'nifty_impact': meter_status(meters['nifty_futures']),
+        'bank_impact': meter_status(meters['bank_futures'])
+    }
+    return {
+        'nifty_futures_history': (chart_data['nifty_futures_history'] + [chart_point])[-CHART_HISTORY_POINTS:],
+        'bank_futures_history': (chart_data['bank_futures_history'] + [chart_point])[-CHART_HISTORY_POINTS:]
+    }
+
+def get_view_meters(view, mode=None):
+    """Published meters, recomputed (once per snapshot) only when a non-default normalisation mode is requested"""
+    if mode and mode != ISS_NORMALIZATION_MODE:
+        key = (view['snapshot_version'], 'meters', mode)
+        meters = view_cache.get(key)
+        if meters is None:
+            meters = compute_meters(view, mode)
+            view_cache.set(key, meters)
+        return meters
+    return view.get('meters') or compute_meters(view)
+
+def segment_pcr(rows, pcr_data):
+    """PCR values for just the contracts in this segment"""
+    return {row['tradingSymbol']: pcr_data[row['tradingSymbol']] for row in rows if row['tradingSymbol'] in pcr_data}
+
+def to_columnar(rows, exchange, fields=None):
+    """
+    Rows as column arrays keyed by instrument slot. Static metadata (symbol,
+    name, company, weight) is left out; clients join it from /api/instruments.
+    """
+    if fields is None:
+        fields = [field for field in ROW_FLOAT_FIELDS + ROW_INT_FIELDS if field != 'pcr' or any('pcr' in row for row in rows)]
+        fields += [field for field in ROW_DERIVED_FIELDS if any(field in row for row in rows)]
+        if any(row.get('stale') for row in rows):
+            fields += ['stale', 'ageSeconds']
+    return {
+        'slots': [INSTRUMENT_SLOTS[(exchange, row['token'])] for row in rows],
+        'columns': {field: [row.get(field) for row in rows] for field in fields}
+    }
+
+def compact_response(payload, fmt, etag=None):
+    """Serialize without key sorting or whitespace, as JSON or MessagePack"""
+    if fmt == 'msgpack':
+        response = app.response_class(msgpack.packb(payload, use_bin_type=True), mimetype='application/x-msgpack')
+    else:
+        response = app.response_class(json.dumps(payload, separators=(',', ':')), mimetype='application/json')
+    if etag:
+        response.set_etag(etag)
+    return response
+
+def get_response_format():
+    """'json' (default), 'compact' or 'msgpack' from ?format=; raises ValueError if unusable"""
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'compact', 'msgpack'):
+        raise ValueError(f'Invalid format: {fmt}')
+    if fmt == 'msgpack' and msgpack is None:
+        raise ValueError('MessagePack output requires the msgpack package')
+    return fmt
+
+def get_meter_mode():
+    """ISS normalisation mode from ?mode= (server default if absent); raises ValueError if unknown"""
+    mode = request.args.get('mode') or ISS_NORMALIZATION_MODE
+    if mode not in ISS_MODES:
+        raise ValueError(f"mode must be one of {', '.join(ISS_MODES)}")
+    return mode
+
+def build_chart_payload(view, meters):
+    """Chart history plus the current meters, in the /api/chart-data shape"""
+    return {
+        'nifty_futures_history': view['chart_data']['nifty_futures_history'],
+        'bank_futures_history': view['chart_data']['bank_futures_history'],
+        'current': {
+            'nifty_meter': meters['nifty_futures']['value'],
+            'bank_meter': meters['bank_futures']['value'],
+            'nifty_impact': meter_status(meters['nifty_futures']),
+            'bank_impact': meter_status(meters['bank_futures']),
+            'timestamp': view['last_update'].strftime('%H:%M') if view.get('last_update') else None
+        }
+    }
+
+# ====== BASKETS ======
+# User-defined baskets (sectors, themes, client portfolios) are compiled into
+# one sparse weight matrix over the instrument slots (CSR: indptr/indices/
+# weights). Every snapshot is reduced to dense per-slot ISS input columns, so
+# scoring all baskets is a single sparse matrix product plus normalisation.
+BASKETS_FILE = os.path.join(STATE_DIR, 'baskets.json')
+BASKET_LIMIT = int(os.environ.get('BASKET_LIMIT', 5000))
+BASKET_NAME_CHARS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-')
+
+basket_registry = {}  # {name: {'label', 'members': [{'exchange', 'token', 'symbol', 'weight'}]}}
+basket_matrix = {'names': [], 'indptr': array('l', [0]), 'indices': array('l'), 'weights': array('d'), 'invalid': {}}
+basket_registry_lock = threading.Lock()
+baskets_load_error = None  # Set when baskets.json exists but could not be read; the file is then never overwritten
+INSTRUMENT_SYMBOLS = {(instrument['exchange'], instrument['symbol']): instrument['slot'] for instrument in INSTRUMENTS}
+
+def resolve_basket_member(member):
+    """Instrument slot for a basket member given by token or symbol (exchange defaults to NSE)"""
+    exchange = member.get('exchange', 'NSE')
+    if member.get('token') is not None:
+        return INSTRUMENT_SLOTS.get((exchange, str(member['token'])))
+    return INSTRUMENT_SYMBOLS.get((exchange, member.get('symbol')))
+
+def compile_basket(members):
+    """
+    Validate basket members and merge them into a sparse (slots, weights) vector.
+    Raises ValueError naming any member that is not in the tracked universe.
+    """
+    if not isinstance(members, list) or not members:
+        raise ValueError('members must be a non-empty list')
+    vector = {}
+    unknown = []
+    for member in members:
+        if not isinstance(member, dict):
+            raise ValueError('each member must be an object')
+        try:
+            weight = float(member.get('weight', 1.0))
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid weight for {member.get('symbol') or member.get('token')}")
+        if not weight > 0:
+            raise ValueError(f"weight must be positive for {member.get('symbol') or member.get('token')}")
+        slot = resolve_basket_member(member)
+        if slot is None:
+            unknown.append(member.get('symbol') or member.get('token'))
+            continue
+        vector[slot] = vector.get(slot, 0.0) + weight
+    if unknown:
+        raise ValueError(f"unknown instruments: {', '.join(map(str, unknown))}")
+    slots = sorted(vector)
+    return slots, [vector[slot] for slot in slots]
+
+def compile_basket_matrix(registry):
+    """
+    Stack every basket's sparse weight vector into one CSR matrix. Baskets
+    that no longer compile (e.g. a member dropped from the index CSVs) stay
+    in the registry but are left out of the matrix, with the reason in
+    matrix['invalid'].
+    """
+    matrix = {'names': [], 'indptr': array('l', [0]), 'indices': array('l'), 'weights': array('d'), 'invalid': {}}
+    for name, basket in registry.items():
+        try:
+            slots, weights = compile_basket(basket['members'])
+        except ValueError as e:
+            matrix['invalid'][name] = str(e)
+            continue
+        matrix['names'].append(name)
+        matrix['indices'].extend(slots)
+        matrix['weights'].extend(weights)
+        matrix['indptr'].append(len(matrix['indices']))
+    return matrix
+
+def load_baskets():
+    """Load the persisted basket registry and compile it"""
+    global basket_registry, basket_matrix, baskets_load_error
+    try:
+        with open(BASKETS_FILE) as f:
+            registry = json.load(f)
+        basket_matrix = compile_basket_matrix(registry)
+        basket_registry = registry
+        print(f"📂 Loaded {len(basket_registry)} baskets")
+        for name, error in basket_matrix['invalid'].items():
+            print(f"⚠️ Basket {name} is not scored: {error}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        baskets_load_error = str(e)
+        print(f"⚠️ Could not load baskets: {e}")
+
+def save_baskets(registry):
+    """Persist the basket registry, unless the stored one failed to load and would be lost"""
+    if baskets_load_error:
+        raise RuntimeError(f'{BASKETS_FILE} could not be loaded ({baskets_load_error}); fix it before changing baskets')
+    atomic_write_json(BASKETS_FILE, registry)
+
+def snapshot_component_columns(view):
+    """
+    Dense per-slot ISS inputs for a snapshot: price change, OI change, PCR and
+    a 0/1 column marking which instruments were quoted.
+    """
+    size = len(INSTRUMENTS)
+    price, oi, pcr, quoted = (array('d', [0.0]) * size for _ in range(4))
+    for segment in SEGMENTS:
+        for row in view.get(segment['key']) or []:
+            slot = INSTRUMENT_SLOTS.get((segment['exchange'], row['token']))
+            if slot is not None:
+                price[slot], oi[slot], pcr[slot] = instrument_components(row)
+                quoted[slot] = 1.0
+    return price, oi, pcr, quoted
+
+def basket_components(matrix, columns):
+    """
+    Sparse weight matrix × dense component columns: weighted-average ISS
+    inputs per basket (None for baskets with no quoted member).
+    """
+    price, oi, pcr, quoted = columns
+    indptr, indices, weights = matrix['indptr'], matrix['indices'], matrix['weights']
+    results = []
+    for row in range(len(matrix['names'])):
+        start, end = indptr[row], indptr[row + 1]
+        slots = indices[start:end]
+        row_weights = weights[start:end]
+        # Members missing from this snapshot drop out of the denominator too
+        quoted_weights = array('d', map(math.prod, zip(row_weights, map(quoted.__getitem__, slots))))
+        total_weight = math.fsum(quoted_weights)
+        if total_weight <= 0:
+            results.append(None)
+            continue
+        results.append({
+            'price': math.fsum(map(math.prod, zip(quoted_weights, map(price.__getitem__, slots)))) / total_weight,
+            'oi': math.fsum(map(math.prod, zip(quoted_weights, map(oi.__getitem__, slots)))) / total_weight,
+            'pcr': math.fsum(map(math.prod, zip(quoted_weights, map(pcr.__getitem__, slots)))) / total_weight,
+            'total_weight': total_weight,
+            'coverage': total_weight / math.fsum(row_weights)
+        })
+    return results
+
+def basket_stats_key(name):
+    """iss_stats key for a basket, kept apart from the segment keys"""
+    return f"basket:{name}"
+
+def evaluate_baskets(view, mode=None, update_stats=False, columns=None):
+    """ISS meter for every registered basket against one snapshot"""
+    matrix = basket_matrix
+    components = basket_components(matrix, columns or snapshot_component_columns(view))
+    baskets = {name: {'value': None, 'coverage': 0.0, 'error': error} for name, error in matrix['invalid'].items()}
+    for name, basket_inputs in zip(matrix['names'], components):
+        if basket_inputs is None:
+            baskets[name] = {'value': None, 'coverage': 0.0}
+            continue
+        if update_stats:
+            update_component_stats(basket_stats_key(name), basket_inputs)
+        value, used_mode, _ = score_meter_components(basket_inputs, mode, basket_stats_key(name))
+        baskets[name] = {
+            'value': round(value, 3),
+            **get_meter_status(value),
+            'mode': used_mode,
+            'coverage': round(basket_inputs['coverage'], 4),
+            'components': {component: round(basket_inputs[component], 4) for component in ISS_COMPONENTS}
+        }
+    return baskets
+
+def get_view_baskets(view, mode=None):
+    """Published basket meters, recomputed (once per snapshot) only when a non-default normalisation mode is requested"""
+    if mode and mode != ISS_NORMALIZATION_MODE:
+        key = (view['snapshot_version'], 'baskets', mode)
+        baskets = view_cache.get(key)
+        if baskets is None:
+            baskets = evaluate_baskets(view, mode)
+            view_cache.set(key, baskets)
+        return baskets
+    return view.get('baskets') or {}
+
+# ====== ALERTS ======
+# Rules are indexed by the input they watch: (source, target, field). Each
+# snapshot only looks at inputs whose value changed, and threshold rules on
+# one input are kept sorted so the crossed ones are found by bisection.
+# Instrument rules target (exchange, token), resolved to a universe slot per
+# snapshot, so they survive index CSV changes that move slots around.
+ALERT_RULES_FILE = os.path.join(STATE_DIR, 'alert_rules.json')
+ALERT_HISTORY_SIZE = int(os.environ.get('ALERT_HISTORY_SIZE', 500))
+ALERT_WEBHOOK_URL = os.environ.get('ALERT_WEBHOOK_URL')
+ALERT_STREAM_SECONDS = 300  # SSE connections end after this; EventSource reconnects on its own
+ALERT_STREAM_MAX_CLIENTS = int(os.environ.get('ALERT_STREAM_MAX_CLIENTS', 2))  # each open stream holds a worker thread
+ALERT_SOURCES = {'meter': ('value',), 'basket': ('value',), 'instrument': ('percentChange', 'oiChange')}
+ALERT_OPS = ('above', 'below', 'cross', 'zone')
+
+def threshold_of(entry):
+    return entry[0]
+
+class AlertEngine:
+    """
+    Incremental rule evaluation. Threshold rules fire when their input crosses
+    the threshold between two snapshots; zone rules fire when a meter's status
+    changes. The first value seen for an input only sets the baseline.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.thresholds = {}  # {input_key: [(threshold, rule_id)] sorted by threshold}
+        self.zones = {}  # {input_key: [rule_id]}
+        self.last_values = {}  # {input_key: value seen in the previous snapshot}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def input_key(rule):
+        target = (rule['exchange'], rule['target']) if rule['source'] == 'instrument' else rule['target']
+        if rule['op'] == 'zone':
+            return (rule['source'], target, 'status')
+        return (rule['source'], target, rule['field'])
+
+    def add(self, rule):
+        with self.lock:
+            self.rules[rule['id']] = rule
+            key = self.input_key(rule)
+            if rule['op'] == 'zone':
+                self.zones.setdefault(key, []).append(rule['id'])
+            else:
+                bisect.insort(self.thresholds.setdefault(key, []), (rule['threshold'], rule['id']))
+
+    def remove(self, rule_id):
+        with self.lock:
+            rule = self.rules.pop(rule_id, None)
+            if rule is None:
+                return False
+            key = self.input_key(rule)
+            if rule['op'] == 'zone':
+                entries = [entry for entry in self.zones[key] if entry != rule_id]
+                index = self.zones
+            else:
+                entries = [entry for entry in self.thresholds[key] if entry[1] != rule_id]
+                index = self.thresholds
+            if entries:
+                index[key] = entries
+            else:
+                del index[key]
+                if key not in self.zones and key not in self.thresholds:
+                    self.last_values.pop(key, None)
+            return True
+
+    def watched(self):
+        """Input keys that have at least one rule"""
+        return set(self.thresholds) | set(self.zones)
+
+    def evaluate(self, values):
+        """
+        Compare {input_key: value} against the previous snapshot and return
+        the rules that fired as (rule, previous, value) tuples.
+        """
+        fired = []
+        with self.lock:
+            for key, value in values.items():
+                previous = self.last_values.get(key)
+                self.last_values[key] = value
+                if previous is None or value is None or previous == value:
+                    continue
+                for rule_id in self.zones.get(key, ()):
+                    rule = self.rules[rule_id]
+                    if not rule.get('to') or rule['to'] == value:
+                        fired.append((rule, previous, value))
+                entries = self.thresholds.get(key)
+                if not entries:
+                    continue
+                if value > previous:
+                    # Rising: thresholds t with previous < t <= value
+                    crossed = entries[bisect.bisect_right(entries, previous, key=threshold_of):
+                                      bisect.bisect_right(entries, value, key=threshold_of)]
+                    wanted = ('above', 'cross')
+                else:
+                    # Falling: thresholds t with value <= t < previous
+                    crossed = entries[bisect.bisect_left(entries, value, key=threshold_of):
+                                      bisect.bisect_left(entries, previous, key=threshold_of)]
+                    wanted = ('below', 'cross')
+                for _, rule_id in crossed:
+                    rule = self.rules[rule_id]
+                    if rule['op'] in wanted:
+                        fired.append((rule, previous, value))
+        return fired
+
+alert_engine = AlertEngine()
+alert_history = deque(maxlen=ALERT_HISTORY_SIZE)  # Local sink, also served by /api/alerts
+alert_subscribers = set()  # One queue per open SSE stream
+alert_subscribers_lock = threading.Lock()
+alert_sequence = itertools.count(1)
+webhook_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='alert-webhook')
+
+def normalize_alert_rule(body):
+    """Validate a rule from the API into its stored form; raises ValueError"""
+    source = body.get('source')
+    if source not in ALERT_SOURCES:
+        raise ValueError(f"source must be one of {', '.join(ALERT_SOURCES)}")
+    op = body.get('op')
+    if op not in ALERT_OPS:
+        raise ValueError(f"op must be one of {', '.join(ALERT_OPS)}")
+    field = body.get('field', ALERT_SOURCES[source][0])
+    if field not in ALERT_SOURCES[source]:
+        raise ValueError(f"field for {source} rules must be one of {', '.join(ALERT_SOURCES[source])}")
+    
+    target = body.get('target')
+    if source == 'meter' and (target not in SEGMENTS_BY_KEY or SEGMENTS_BY_KEY[target]['exchange'] != 'NFO'):
+        raise ValueError(f'Unknown meter: {target}')
+    if source == 'basket' and target not in basket_registry:
+        raise ValueError(f'Unknown basket: {target}')
+    instrument = None
+    if source == 'instrument':
+        slot = resolve_basket_member({'exchange': body.get('exchange', 'NSE'), 'symbol': body.get('symbol'), 'token': body.get('token')})
+        if slot is None:
+            raise ValueError('Unknown instrument')
+        instrument = INSTRUMENTS[slot]
+        target = instrument['token']
+        if field == 'oiChange' and instrument['exchange'] != 'NFO':
+            raise ValueError('oiChange rules apply to NFO futures only')
+    
+    rule = {'id': uuid.uuid4().hex[:12], 'source': source, 'target': target, 'field': field, 'op': op, 'label': body.get('label')}
+    if instrument:
+        rule['exchange'] = instrument['exchange']
+        rule['symbol'] = instrument['symbol']
+    if op == 'zone':
+        if source == 'instrument':
+            raise ValueError('zone rules apply to meters and baskets only')
+        rule['to'] = body.get('to')
+        if rule['to'] is not None and rule['to'] not in METER_STATUSES:
+            raise ValueError(f"to must be one of {', '.join(METER_STATUSES)}")
+    else:
+        try:
+            rule['threshold'] = float(body['threshold'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('threshold must be a number')
+    return rule
+
+def load_alert_rules():
+    """Load persisted alert rules into the engine"""
+    try:
+        with open(ALERT_RULES_FILE) as f:
+            rules = json.load(f)
+        # Instrument rules from before token targets pointed at slots; those no longer resolve reliably.
+        # oiChange on cash instruments was never open interest, so those are dropped too.
+        rules = [
+            rule for rule in rules
+            if rule['source'] != 'instrument' or ('exchange' in rule and (rule['field'] != 'oiChange' or rule['exchange'] == 'NFO'))
+        ]
+        for rule in rules:
+            alert_engine.add(rule)
+        print(f"📂 Loaded {len(rules)} alert rules")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Could not load alert rules: {e}")
+
+def save_alert_rules():
+    """Persist alert rules"""
+    atomic_write_json(ALERT_RULES_FILE, list(alert_engine.rules.values()))
+
+def collect_alert_inputs(view, meters, baskets, columns):
+    """Current value of every input some rule watches"""
+    price, _, _, quoted = columns
+    futures_rows = None
+    values = {}
+    for key in alert_engine.watched():
+        source, target, field = key
+        if source == 'instrument' and field == 'oiChange':
+            # Real open interest change %, not the ISS OI column (a volume proxy when OI change is unknown)
+            if futures_rows is None:
+                futures_rows = {
+                    (segment['exchange'], row['token']): row
+                    for segment in SEGMENTS if segment['exchange'] == 'NFO' for row in view.get(segment['key']) or []
+                }
+            row = futures_rows.get(target)
+            values[key] = row['netChangeOpnInterest'] / row['opnInterest'] * 100 if row and row.get('opnInterest') else None
+        elif source == 'instrument':
+            slot = INSTRUMENT_SLOTS.get(target)  # None once the instrument leaves the universe
+            values[key] = price[slot] if slot is not None and quoted[slot] else None
+        else:
+            meter = (meters if source == 'meter' else baskets).get(target) or {}
+            values[key] = meter.get('status' if field == 'status' else 'value')
+    return values
+
+def describe_alert(rule, previous, value):
+    """Human-readable one-liner for a fired rule"""
+    name = rule.get('symbol') or rule['target']
+    if rule['op'] == 'zone':
+        return f"{name} moved from {previous} to {value}"
+    return f"{name} {rule['field']} crossed {rule['threshold']:g} ({previous:.3f} → {value:.3f})"
+
+def check_alerts(view, meters, baskets, columns=None, notify=True):
+    """Evaluate alert rules against a published snapshot and dispatch what fired"""
+    if not alert_engine.rules:
+        return []
+    fired = alert_engine.evaluate(collect_alert_inputs(view, meters, baskets, columns or snapshot_component_columns(view)))
+    if not notify or not fired:
+        return []
+    at = (view.get('last_update') or get_ist_time()).strftime('%Y-%m-%d %H:%M:%S IST')
+    alerts = [{
+        'seq': next(alert_sequence),
+        'rule_id': rule['id'],
+        'label': rule.get('label'),
+        'message': describe_alert(rule, previous, value),
+        'previous': previous,
+        'value': value,
+        'at': at
+    } for rule, previous, value in fired]
+    dispatch_alerts(alerts)
+    return alerts
+
+def dispatch_alerts(alerts):
+    """Send fired alerts to the local history, open SSE streams and the webhook"""
+    alert_history.extend(alerts)
+    for subscriber in list(alert_subscribers):
+        for alert in alerts:
+            try:
+                subscriber.put_nowait(alert)
+            except queue.Full:
+                pass  # Slow client; it can catch up from /api/alerts?since=
+    if ALERT_WEBHOOK_URL:
+        webhook_executor.submit(post_alert_webhook, alerts)
+    print(f"🚨 {len(alerts)} alert(s) fired: {'; '.join(alert['message'] for alert in alerts[:3])}{' ...' if len(alerts) > 3 else ''}")
+
+def post_alert_webhook(alerts):
+    """POST fired alerts to ALERT_WEBHOOK_URL (runs off the refresh path)"""
+    try:
+        requests.post(ALERT_WEBHOOK_URL, json={'alerts': alerts}, timeout=10)
+    except Exception as e:
+        print(f"⚠️ Alert webhook failed: {e}")
+
+# ====== SNAPSHOT PERSISTENCE ======
+# Binary snapshot layout (all offsets relative to the end of the header):
+#   MAGIC (8 bytes) | header length (uint32 LE) | header JSON | sections...
+# Segment rows are stored column-wise: a JSON list of [token, tradingSymbol]
+# plus one packed float64/int64 array per live field. Static instrument
+# metadata (name, company, weight) is rebuilt from the segment token maps.
+SNAPSHOT_FILE = os.path.join(STATE_DIR, 'snapshot.bin')
+SNAPSHOT_MAGIC = b'IDSNAP01'
+WARM_START_REFRESH = os.environ.get('WARM_START_REFRESH', 'true').lower() == 'true'
+ROW_FLOAT_FIELDS = ('ltp', 'open', 'high', 'low', 'close', 'netChange', 'percentChange', 'pcr')
+ROW_INT_FIELDS = ('tradeVolume', 'netChangeOpnInterest', 'opnInterest')
+# Futures-only fields derived from the curves and the OI series; not persisted
+ROW_DERIVED_FIELDS = ('combinedOpnInterest', 'combinedNetChangeOpnInterest', 'rolloverPct', 'calendarSpread',
+                      'oiChangeFromOpen', 'oiVelocity', 'oiBuildup', 'priceOiDivergence')
+
+def encode_snapshot():
+    """Serialize the current snapshot into the compact binary layout"""
+    sections = []
+    section_index = {}
+    
+    def add_section(name, payload):
+        offset = sum(len(data) for data in sections)
+        sections.append(payload)
+        section_index[name] = [offset, len(payload)]
+    
+    def add_json(name, value):
+        add_section(name, json.dumps(value, separators=(',', ':')).encode())
+    
+    segments = {}
+    for segment in SEGMENTS:
+        rows = cached_data.get(segment['key']) or []
+        key = segment['key']
+        add_json(f'{key}.ids', [[row['token'], row['tradingSymbol']] for row in rows])
+        for field in ROW_FLOAT_FIELDS:
+            add_section(f'{key}.{field}', array('d', (row.get(field, math.nan) for row in rows)).tobytes())
+        for field in ROW_INT_FIELDS:
+            add_section(f'{key}.{field}', array('q', (row.get(field, 0) for row in rows)).tobytes())
+        segments[key] = len(rows)
+    
+    add_json('pcr_data', cached_data.get('pcr_data') or {})
+    add_json('option_chains', cached_data.get('option_chains') or {})
+    add_json('futures_curves', cached_data.get('futures_curves') or {})
+    add_json('chart_data', cached_data['chart_data'])
+    add_json('auth', {
+        'token': cached_data.get('auth_token'),
+        'obtained_at': cached_data['auth_obtained_at'].isoformat() if cached_data.get('auth_obtained_at') else None
+    })
+    
+    header = json.dumps({
+        'snapshot_version': cached_data['snapshot_version'],
+        'last_update': cached_data['last_update'].isoformat() if cached_data.get('last_update') else None,
+        'byteorder': sys.byteorder,
+        'segments': segments,
+        'sections': section_index
+    }, separators=(',', ':')).encode()
+    return b''.join([SNAPSHOT_MAGIC, struct.pack('<I', len(header)), header] + sections)
+
+def save_snapshot():
+    """Atomically replace the on-disk snapshot with the current one"""
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = f"{SNAPSHOT_FILE}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_snapshot())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, SNAPSHOT_FILE)
+    except Exception as e:
+        print(f"⚠️ Could not save snapshot: {e}")
+
+def load_snapshot():
+    """
+    Memory-map the persisted snapshot and serve it as the current (stale)
+    data until the first live refresh completes. Returns True if loaded.
+    """
+    try:
+        with open(SNAPSHOT_FILE, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                print("⚠️ Ignoring snapshot with unknown format")
+                return False
+            header_start = len(SNAPSHOT_MAGIC) + 4
+            header_len = struct.unpack_from('<I', mm, len(SNAPSHOT_MAGIC))[0]
+            header = json.loads(mm[header_start:header_start + header_len])
+            base = header_start + header_len
+            
+            def section(name):
+                offset, length = header['sections'][name]
+                return mm[base + offset:base + offset + length]
+            
+            def read_array(name, typecode):
+                values = array(typecode)
+                values.frombytes(section(name))
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+                return values
+            
+            for segment in SEGMENTS:
+                key = segment['key']
+                if key not in header['segments']:
+                    continue
+                ids = json.loads(section(f'{key}.ids'))
+                columns = {field: read_array(f'{key}.{field}', 'd') for field in ROW_FLOAT_FIELDS}
+                columns.update({field: read_array(f'{key}.{field}', 'q') for field in ROW_INT_FIELDS})
+                
+                rows = []
+                for i, (token, trading_symbol) in enumerate(ids):
+                    stock_info = segment['tokens'].get(token)
+                    if stock_info is None:  # Instrument dropped from the universe since the snapshot
+                        continue
+                    row = {
+                        'token': token,
+                        'symbol': stock_info['symbol'],
+                        'name': stock_info['name'],
+                        'company': stock_info['company'],
+                        'weight': stock_info['weight']
+                    }
+                    for field, values in columns.items():
+                        if not math.isnan(values[i]):
+                            row[field] = values[i]
+                    row['tradingSymbol'] = trading_symbol
+                    rows.append(row)
+                cached_data[key] = rows
+            
+            cached_data['pcr_data'] = json.loads(section('pcr_data'))
+            cached_data['option_chains'] = json.loads(section('option_chains'))
+            if 'futures_curves' in header['sections']:  # Absent in snapshots written before multi-expiry tracking
+                cached_data['futures_curves'] = json.loads(section('futures_curves'))
+                for segment in SEGMENTS:
+                    if segment['exchange'] == 'NFO':
+                        apply_futures_curves(cached_data.get(segment['key']), cached_data['futures_curves'])
+            for segment in SEGMENTS:
+                if segment['exchange'] == 'NFO':
+                    apply_oi_metrics(cached_data.get(segment['key']))  # Series was rebuilt from the journal by load_oi_series()
+            cached_data['chart_data'] = json.loads(section('chart_data'))
+            auth = json.loads(section('auth'))
+        
+        cached_data['meters'] = compute_meters(cached_data)
+        cached_data['baskets'] = evaluate_baskets(cached_data)
+        cached_data['basis'] = compute_basis(cached_data)
+        check_alerts(cached_data, cached_data['meters'], cached_data['baskets'], notify=False)  # Baseline only
+        cached_data['snapshot_version'] = header['snapshot_version']
+        cached_data['last_update'] = datetime.fromisoformat(header['last_update']) if header['last_update'] else None
+        cached_data['stale'] = True
+        
+        # JWT sessions are issued per trading day; reuse today's token
+        if auth.get('token') and auth.get('obtained_at'):
+            obtained_at = datetime.fromisoformat(auth['obtained_at'])
+            if obtained_at.date() == get_ist_time().date():
+                cached_data['auth_token'] = auth['token']
+                cached_data['auth_obtained_at'] = obtained_at
+        
+        print(f"♻️ Warm start from snapshot v{header['snapshot_version']} ({header['last_update']})")
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        print(f"⚠️ Could not load snapshot: {e}")
+        return False
+
+def background_refresh():
+    """Catch up with the market after a warm start without blocking requests"""
+    try:
+        coalesced_refresh()
+        print("✅ Background refresh after warm start completed")
+    except Exception as e:
+        print(f"💥 Background refresh failed: {e}")
+
+def warm_start():
+    """Serve the persisted snapshot immediately and refresh it in the background"""
+    if load_snapshot() and WARM_START_REFRESH and is_refresh_due():
+        threading.Thread(target=background_refresh, name='warm-start-refresh', daemon=True).start()
+
+# ====== SNAPSHOT JOURNAL ======
+# Every published snapshot is appended as one NDJSON line to a per-day file,
+# so /api/export can stream a whole session one snapshot at a time.
+JOURNAL_DIR = os.path.join(STATE_DIR, 'journal')
+JOURNAL_RETENTION_DAYS = int(os.environ.get('JOURNAL_RETENTION_DAYS', 30))
+JOURNAL_FIELDS = ('token', 'tradingSymbol') + ROW_FLOAT_FIELDS + ROW_INT_FIELDS + ('stale',)
+
+def journal_path(day):
+    return os.path.join(JOURNAL_DIR, f"{day.isoformat()}.ndjson")
+
+def append_journal():
+    """Append the current snapshot to today's journal, pruning old days when a new file starts"""
+    try:
+        at = cached_data['last_update']
+        path = journal_path(at.date())
+        if not os.path.exists(path):
+            prune_journal(at.date())
+        line = json.dumps({
+            'snapshot_version': cached_data['snapshot_version'],
+            'last_update': at.strftime('%Y-%m-%d %H:%M:%S'),
+            'segments': {
+                segment['key']: [[row.get(field) for field in JOURNAL_FIELDS] for row in cached_data.get(segment['key']) or []]
+                for segment in SEGMENTS
+            },
+            'curve_oi': curve_oi_samples(cached_data.get('futures_curves') if MULTI_EXPIRY_ENABLED else None)
+        }, separators=(',', ':'))
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+    except Exception as e:
+        print(f"⚠️ Could not append snapshot journal: {e}")
+
+def prune_journal(today):
+    """Delete journal days older than JOURNAL_RETENTION_DAYS"""
+    cutoff = (today - timedelta(days=JOURNAL_RETENTION_DAYS)).isoformat()
+    try:
+        for name in os.listdir(JOURNAL_DIR):
+            if name.endswith('.ndjson') and name[:-len('.ndjson')] < cutoff:
+                os.remove(os.path.join(JOURNAL_DIR, name))
+    except FileNotFoundError:
+        pass
+
+def iter_journal(day):
+    """
+    Yield one journalled snapshot at a time (never the whole day). Today's
+    file may be mid-append, so a last line without its newline is skipped.
+    """
+    with open(journal_path(day)) as f:
+        for line in f:
+            if line.endswith('\n') and line.strip():
+                yield json.loads(line)
+
+def export_rows(day, segments):
+    """Flat export records (dicts) for the chosen segments across every snapshot of a day"""
+    for snapshot in iter_journal(day):
+        for segment in segments:
+            for values in snapshot['segments'].get(segment['key']) or []:
+                row = dict(zip(JOURNAL_FIELDS, values))
+                yield {
+                    'snapshot_version': snapshot['snapshot_version'],
+                    'time': snapshot['last_update'],
+                    'segment': segment['route'],
+                    **row
+                }
+
+# ====== OI SERIES ======
+# Every snapshot's OI and LTP per tracked futures contract, kept as packed
+# arrays for the current session. OI change from the open or the previous
+# session is O(1); rolling velocity bisects the sample times. Next/far month
+# contracts from the futures curves are recorded too, so every expiry has a
+# reference OI. The series is rebuilt from the snapshot journal after a restart.
+OI_VELOCITY_MINUTES = int(os.environ.get('OI_VELOCITY_MINUTES', 30))
+
+class OISeries:
+    """One contract's intraday samples: epoch seconds, OI and LTP in parallel arrays"""
+    __slots__ = ('times', 'oi', 'ltp')
+
+    def __init__(self):
+        self.times = array('q')
+        self.oi = array('q')
+        self.ltp = array('d')
+
+    def append(self, at, oi, ltp):
+        if self.times and at <= self.times[-1]:
+            return
+        self.times.append(at)
+        self.oi.append(oi)
+        self.ltp.append(ltp)
+
+    def change_from_open(self):
+        return self.oi[-1] - self.oi[0] if self.oi else 0
+
+    def velocity(self, minutes=OI_VELOCITY_MINUTES):
+        """OI change per minute over the trailing window"""
+        if len(self.times) < 2:
+            return 0.0
+        start = min(bisect.bisect_left(self.times, self.times[-1] - minutes * 60), len(self.times) - 2)
+        return (self.oi[-1] - self.oi[start]) / ((self.times[-1] - self.times[start]) / 60)
+
+    def buildup(self):
+        """Price/OI quadrant since the open: long/short buildup, short covering or long unwinding"""
+        if len(self.oi) < 2:
+            return None
+        price_move = self.ltp[-1] - self.ltp[0]
+        oi_move = self.oi[-1] - self.oi[0]
+        if not price_move or not oi_move:
+            return None
+        if oi_move > 0:
+            return 'long_buildup' if price_move > 0 else 'short_buildup'
+        return 'short_covering' if price_move > 0 else 'long_unwinding'
+
+oi_series = {}  # {token: OISeries} for the current session
+oi_series_state = {'day': None, 'previous_session_oi': {}}  # {token: last OI of the previous session}
+
+def reference_oi(token):
+    """OI to measure today's change against: previous session close, else this session's first sample"""
+    previous = oi_series_state['previous_session_oi'].get(token)
+    if previous:
+        return previous
+    series = oi_series.get(token)
+    return series.oi[0] if series and series.oi else 0
+
+def roll_oi_session(day):
+    """Start a new session's series, keeping each contract's last OI as the previous session close"""
+    if oi_series_state['day'] == day:
+        return
+    if oi_series:
+        oi_series_state['previous_session_oi'] = {token: series.oi[-1] for token, series in oi_series.items() if series.oi}
+    oi_series.clear()
+    oi_series_state['day'] = day
+
+def record_oi_series(segment_data, at):
+    """Append this snapshot's live (non-stale) futures quotes to the OI series"""
+    roll_oi_session(at.date())
+    epoch = int(at.timestamp())
+    for segment in SEGMENTS:
+        if segment['exchange'] != 'NFO':
+            continue
+        for row in segment_data.get(segment['key']) or []:
+            if not row.get('stale') and row.get('opnInterest'):
+                oi_series.setdefault(row['token'], OISeries()).append(epoch, int(row['opnInterest']), float(row.get('ltp') or 0))
+
+def curve_oi_samples(futures_curves):
+    """{token: [oi, ltp]} for quoted curve contracts that no segment tracks"""
+    return {
+        token: [oi, ltp]
+        for curve in (futures_curves or {}).values()
+        for token, oi, ltp in zip(curve['tokens'], curve['oi'], curve['ltp'])
+        if oi and ('NFO', token) not in INSTRUMENT_SLOTS
+    }
+
+def record_curve_series(futures_curves, at):
+    """Append this snapshot's next/far month quotes to the OI series"""
+    roll_oi_session(at.date())
+    epoch = int(at.timestamp())
+    for token, (oi, ltp) in curve_oi_samples(futures_curves).items():
+        oi_series.setdefault(token, OISeries()).append(epoch, int(oi), float(ltp or 0))
+
+def apply_oi_metrics(rows):
+    """Copy OI change from open, velocity and buildup onto futures rows"""
+    for row in rows or []:
+        series = oi_series.get(row['token'])
+        if series is None or not series.oi:
+            continue
+        buildup = series.buildup()
+        row['oiChangeFromOpen'] = series.change_from_open()
+        row['oiVelocity'] = round(series.velocity(), 2)
+        row['oiBuildup'] = buildup
+        row['priceOiDivergence'] = buildup in ('short_buildup', 'short_covering')
+
+def load_oi_series():
+    """Rebuild today's OI series and the previous session close from the snapshot journal"""
+    today = get_ist_time().date()
+    fields = {field: i for i, field in enumerate(JOURNAL_FIELDS)}
+    nfo_keys = [segment['key'] for segment in SEGMENTS if segment['exchange'] == 'NFO']
     
-    print(f"🧠 Institutional Sentiment Score (ISS) Calculation:")
-    print(f"   📊 Weighted Price Change: {avg_price_change:.3f}% → Normalized: {norm_price:.3f}")
-    print(f"   📈 Weighted OI Change: {avg_oi_change:.3f}% → Normalized: {norm_oi:.3f}") 
-    print(f"   🎯 Weighted PCR: {avg_pcr:.3f} → Normalized: {norm_pcr:.3f}")
-    print(f"   🏆 ISS Score: (0.4×{norm_price:.3f}) + (0.4×{norm_oi:.3f}) + (0.2×{norm_pcr:.3f}) = {iss_score:.3f}")
-    print(f"   📋 Processed {len(market_data)} instruments with total weight: {total_weight:.2f}")
+    def snapshot_samples(snapshot):
+        """(token, oi, ltp) of every live futures quote in one journal snapshot"""
+        for key in nfo_keys:
+            for values in snapshot['segments'].get(key) or []:
+                if not values[fields['stale']] and values[fields['opnInterest']]:
+                    yield values[fields['token']], values[fields['opnInterest']], values[fields['ltp']]
+        for token, (oi, ltp) in (snapshot.get('curve_oi') or {}).items():
+            yield token, oi, ltp
     
-    # Debug: Show individual OI changes for top 5 stocks
-    oi_debug = []
-    for stock in market_data[:5]:
-        net_oi = stock.get('netChangeOpnInterest', 0)
-        curr_oi = stock.get('opnInterest', 0)
-        oi_pct = (net_oi / curr_oi * 100) if curr_oi > 0 else 0
-        oi_debug.append(f"{stock.get('symbol', 'N/A')}: {net_oi:,} ({oi_pct:.2f}%)")
-    print(f"   🔍 Sample OI Changes: {', '.join(oi_debug)}")
+    try:
+        last = None
+        for last in iter_journal(previous_trading_day(today)):
+            pass
+        if last:
+            oi_series_state['previous_session_oi'] = {token: oi for token, oi, _ in snapshot_samples(last)}
+    except FileNotFoundError:
+        pass
     
-    return iss_score
+    oi_series_state['day'] = today
+    try:
+        samples = 0
+        for snapshot in iter_journal(today):
+            at = int(datetime.strptime(snapshot['last_update'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=get_ist_time().tzinfo).timestamp())
+            for token, oi, ltp in snapshot_samples(snapshot):
+                oi_series.setdefault(token, OISeries()).append(at, int(oi), float(ltp or 0))
+            samples += 1
+        print(f"📂 Rebuilt OI series for {len(oi_series)} contracts from {samples} snapshots")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Could not rebuild OI series: {e}")
 
-def get_meter_status(iss_score):
-    """Get meter status, color, and trading action based on ISS (0-1 scale)"""
-    if 0.75 <= iss_score <= 1.00:
-        return {
-            "status": "Strong Bullish", 
-            "color": "success", 
-            "icon": "�",
-            "action": "🚀 Go Long (Calls / Futures Buy / BTST Calls)",
-            "trade_type": "Long buildup, heavy long positions",
-            "confidence": "� Strong"
-        }
-    elif 0.60 <= iss_score < 0.75:
-        return {
-            "status": "Mild Bullish", 
-            "color": "info", 
-            "icon": "⚡",
-            "action": "📈 Buy on dips, avoid shorts",
-            "trade_type": "Possible intraday uptrend continuation",
-            "confidence": "⚡ Mild"
-        }
-    elif 0.40 <= iss_score < 0.60:
-        return {
-            "status": "Neutral", 
-            "color": "secondary", 
-            "icon": "⚖️",
-            "action": "⚖️ Avoid directional trades; scalp both sides",
-            "trade_type": "Uncertain / consolidation",
-            "confidence": "⚖️ Neutral"
-        }
-    elif 0.25 <= iss_score < 0.40:
-        return {
-            "status": "Mild Bearish", 
-            "color": "warning", 
-            "icon": "🧊",
-            "action": "📉 Sell on rise, avoid longs",
-            "trade_type": "Short buildup signals forming",
-            "confidence": "🧊 Mild"
-        }
-    else:  # 0.00 <= iss_score < 0.25
+# ====== ADMISSION CONTROL ======
+# The server runs one worker with WORKER_THREADS threads. Endpoints that do
+# live upstream work go through a capped heavy lane; cached reads and health
+# checks use the fast lane, which is never capped, so they keep answering
+# while heavy work is queued. Long-lived streaming responses (SSE, export)
+# get their own small lane and hold their slot until the stream closes.
+# A request that cannot start before its deadline gets 503 + Retry-After
+# instead of hanging. Every thread that can be held by heavy work (running
+# or queued), streams or refresh joiners must fit in WORKER_THREADS minus
+# FAST_LANE_RESERVE, so /ping and /keepalive always find a free thread.
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 12))  # must match gunicorn --threads (see Procfile)
+FAST_LANE_RESERVE = int(os.environ.get('FAST_LANE_RESERVE', 3))
+HEAVY_MAX_CONCURRENT = int(os.environ.get('HEAVY_MAX_CONCURRENT', 2))
+HEAVY_MAX_QUEUE = int(os.environ.get('HEAVY_MAX_QUEUE', 2))
+HEAVY_QUEUE_TIMEOUT = float(os.environ.get('HEAVY_QUEUE_TIMEOUT', 15))  # seconds a heavy request may wait
+STREAM_MAX_CONCURRENT = int(os.environ.get('STREAM_MAX_CONCURRENT', 3))
+
+def check_thread_budget():
+    """Refuse to start if the capped lanes could hold the threads the fast lane needs"""
+    held = HEAVY_MAX_CONCURRENT + HEAVY_MAX_QUEUE + STREAM_MAX_CONCURRENT + REFRESH_MAX_JOINERS
+    if held > WORKER_THREADS - FAST_LANE_RESERVE:
+        raise RuntimeError(
+            f"Admission limits hold up to {held} threads (heavy {HEAVY_MAX_CONCURRENT} + queue {HEAVY_MAX_QUEUE} + "
+            f"stream {STREAM_MAX_CONCURRENT} + refresh joiners {REFRESH_MAX_JOINERS}), more than "
+            f"WORKER_THREADS ({WORKER_THREADS}) - FAST_LANE_RESERVE ({FAST_LANE_RESERVE})"
+        )
+
+check_thread_budget()
+
+class AdmissionLane:
+    """Concurrency cap with a bounded, deadline-aware wait queue (limit=None means uncapped)"""
+
+    def __init__(self, name, limit=None, max_queue=0, queue_timeout=0.0):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.durations = deque(maxlen=50)  # Recent service times, for wait estimates
+        self.waits = deque(maxlen=50)
+        self.cond = threading.Condition()
+
+    def average_duration(self):
+        return sum(self.durations) / len(self.durations) if self.durations else 1.0
+
+    def expected_wait(self):
+        """Estimated seconds until a newly queued request would start"""
+        if self.limit is None or self.in_flight < self.limit:
+            return 0.0
+        return (self.queued + 1) * self.average_duration() / self.limit
+
+    def retry_after(self):
+        return max(1, math.ceil(self.expected_wait()))
+
+    def acquire(self):
+        """Take a slot, waiting up to queue_timeout. Returns False if the request should be shed."""
+        with self.cond:
+            if self.limit is None or (self.in_flight < self.limit and not self.queued):
+                self.in_flight += 1
+                self.admitted += 1
+                self.waits.append(0.0)
+                return True
+            # Shed immediately if the queue is full or the wait would blow the deadline
+            if self.queued >= self.max_queue or self.expected_wait() > self.queue_timeout:
+                self.rejected += 1
+                return False
+            
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            started = time.monotonic()
+            deadline = started + self.queue_timeout
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        self.rejected += 1
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            self.waits.append(time.monotonic() - started)
+            return True
+
+    def release(self, duration):
+        with self.cond:
+            self.in_flight -= 1
+            self.durations.append(duration)
+            self.cond.notify()
+
+    def stats(self):
         return {
-            "status": "Strong Bearish", 
-            "color": "danger", 
-            "icon": "❄️",
-            "action": "💣 Go Short (Puts / Futures Sell / BTST Puts)",
-            "trade_type": "Heavy shorts or profit booking",
-            "confidence": "❄️ Strong"
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'peak_queued': self.peak_queued,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait_seconds': round(sum(self.waits) / len(self.waits), 3) if self.waits else 0.0,
+            'avg_duration_seconds': round(self.average_duration(), 3) if self.durations else None
         }
 
+heavy_lane = AdmissionLane('heavy', HEAVY_MAX_CONCURRENT, HEAVY_MAX_QUEUE, HEAVY_QUEUE_TIMEOUT)
+stream_lane = AdmissionLane('stream', STREAM_MAX_CONCURRENT)  # No queue: streams run for minutes
+fast_lane = AdmissionLane('fast')
+ADMISSION_LANES = {lane.name: lane for lane in (heavy_lane, stream_lane, fast_lane)}
+
+def admission(lane, bypass=None):
+    """
+    Route decorator running the view inside an admission lane. bypass is an
+    optional predicate; when it returns True the request is cheap and is
+    served through the fast lane instead. A streamed response keeps its slot
+    until the server closes it, not just until the view returns.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            chosen = fast_lane if bypass and bypass() else lane
+            if not chosen.acquire():
+                response = jsonify({
+                    'status': 'error',
+                    'message': f'Server busy ({chosen.name} operations at capacity), retry later'
+                })
+                response.status_code = 503
+                response.headers['Retry-After'] = str(chosen.retry_after())
+                return response
+            started = time.monotonic()
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                chosen.release(time.monotonic() - started)
+                raise
+            if isinstance(response, app.response_class) and response.is_streamed:
+                response.call_on_close(lambda: chosen.release(time.monotonic() - started))
+            else:
+                chosen.release(time.monotonic() - started)
+            return response
+        return wrapper
+    return decorator
+
+def refresh_is_cheap():
+    """True when /api/refresh-data will not call upstream (skipped, joining an in-flight refresh, or a fresh result is reused)"""
+    if refresh_in_flight is not None:
+        return True  # Coalesced onto the running refresh, even when forced
+    if request.args.get('force', 'false').lower() == 'true':
+        return False
+    finished_at = last_refresh['finished_at']
+    return not is_refresh_due() or (finished_at is not None and time.monotonic() - finished_at < REFRESH_FRESHNESS_SECONDS)
+
 @app.route('/test/dates')
 def test_dates():
     """Test the improved date calculation"""
@@ -697,12 +3021,16 @@ def test_dates():
         previous_day = get_previous_trading_day()
         result.append(f"Previous trading day: {previous_day.strftime('%A, %Y-%m-%d')}")
         
-        # Test multiple days back
+        # Test multiple sessions back
+        test_date = today.date()
         for i in range(1, 4):
-            test_date = today.date() - timedelta(days=i)
-            while test_date.weekday() >= 5:
-                test_date = test_date - timedelta(days=1)
+            test_date = previous_trading_day(test_date)
             result.append(f"{i} trading day(s) back: {test_date.strftime('%A, %Y-%m-%d')}")
+        
+        result.append(f"Market phase: {get_market_phase(today)}")
+        result.append(f"Next session open: {next_session_open(today).strftime('%A, %Y-%m-%d %H:%M')}")
+        if today.date() in NSE_HOLIDAYS:
+            result.append(f"Exchange holiday: {NSE_HOLIDAYS[today.date()]}")
             
     except Exception as e:
         result.append(f"Error: {e}")
@@ -710,6 +3038,7 @@ def test_dates():
     return "<br>".join(result)
 
 @app.route('/test/oi')
+@admission(heavy_lane)
 def test_oi_endpoint():
     """Test endpoint for historical OI API"""
     result = test_historical_oi()
@@ -720,7 +3049,24 @@ def index():
     """Main dashboard"""
     return render_template('index.html')
 
+@app.route('/api/market-status')
+@admission(fast_lane)
+def market_status():
+    """Current NSE session phase and when the dashboard should poll next"""
+    now = get_ist_time()
+    return jsonify({
+        'phase': get_market_phase(now),
+        'is_trading_day': is_trading_day(now.date()),
+        'holiday': NSE_HOLIDAYS.get(now.date()),
+        'refresh_due': is_refresh_due(now),
+        'next_poll_seconds': get_next_poll_seconds(now),
+        'next_session_open': next_session_open(now).strftime('%Y-%m-%d %H:%M IST'),
+        'previous_session': previous_trading_day(now.date()).strftime('%Y-%m-%d'),
+        'timestamp': now.strftime('%Y-%m-%d %H:%M:%S IST')
+    })
+
 @app.route('/ping')
+@admission(fast_lane)
 def ping():
     """Simple ping endpoint for health checks and keepalive"""
     return jsonify({
@@ -730,16 +3076,12 @@ def ping():
     })
 
 @app.route('/keepalive')
+@admission(fast_lane)
 def keepalive():
     """Keepalive endpoint with app status"""
     try:
         # Check if we have cached data
-        has_data = any([
-            cached_data.get('nifty_50'),
-            cached_data.get('bank_nifty'),
-            cached_data.get('nifty_futures'),
-            cached_data.get('bank_futures')
-        ])
+        has_data = any(cached_data.get(segment['key']) for segment in SEGMENTS)
         
         return jsonify({
             'status': 'healthy',
@@ -748,6 +3090,8 @@ def keepalive():
             'has_auth_token': bool(cached_data.get('auth_token')),
             'has_market_data': has_data,
             'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data.get('last_update') else None,
+            'stale': cached_data['stale'],
+            'snapshot_version': cached_data['snapshot_version'],
             'uptime': 'running'
         })
     except Exception as e:
@@ -767,6 +3111,7 @@ def debug_simple():
             'timestamp': get_ist_time().strftime('%Y-%m-%d %H:%M:%S IST'),
             'nifty_50_tokens': len(NIFTY_50_STOCKS),
             'bank_nifty_tokens': len(BANK_NIFTY_STOCKS),
+            'instrument_count': len(INSTRUMENTS),
             'cached_data_keys': list(cached_data.keys()),
             'api_key_present': bool(API_KEY),
             'username_present': bool(USERNAME)
@@ -778,6 +3123,7 @@ def debug_simple():
         }), 500
 
 @app.route('/debug/auth')
+@admission(heavy_lane)
 def debug_auth():
     """Test authentication only"""
     try:
@@ -798,6 +3144,7 @@ def debug_auth():
         }), 500
 
 @app.route('/debug/fetch-test')
+@admission(heavy_lane)
 def debug_fetch_test():
     """Test fetching data for just one token"""
     try:
@@ -825,42 +3172,64 @@ def debug_fetch_test():
         }), 500
 
 @app.route('/api/refresh-data')
+@admission(heavy_lane, bypass=refresh_is_cheap)
 def refresh_data():
     """Refresh all market data"""
     try:
+        force = request.args.get('force', 'false').lower() == 'true'
+        
+        # Outside the session there is nothing new upstream; serve the last snapshot
+        if not is_refresh_due() and not force:
+            print(f"⏸️ Skipping refresh, market is {get_market_phase()}")
+            return jsonify({
+                'status': 'success',
+                'message': f'Market {get_market_phase()} - serving last snapshot',
+                'skipped': True,
+                'timestamp': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST'),
+                'next_poll_seconds': get_next_poll_seconds(),
+                'data_counts': {segment['key']: len(cached_data.get(segment['key']) or []) for segment in SEGMENTS}
+            })
+        
         print("🔄 Starting data refresh...")
         
         # Test authentication first
         if not cached_data.get('auth_token'):
             print("🔑 Authenticating...")
             if not authenticate():
+                last_refresh['failed_at'] = time.monotonic()
                 return jsonify({
                     'status': 'error',
-                    'message': 'Authentication failed'
+                    'message': 'Authentication failed',
+                    'next_poll_seconds': get_next_poll_seconds()
                 }), 500
         
-        # Fetch all data
-        print("📊 Fetching market data...")
-        cached_data['nifty_50'] = fetch_market_data(NIFTY_50_STOCKS, "NSE")
-        cached_data['bank_nifty'] = fetch_market_data(BANK_NIFTY_STOCKS, "NSE")
-        cached_data['pcr_data'] = fetch_pcr_data()
-        cached_data['nifty_futures'] = fetch_market_data(NIFTY_50_FUTURES, "NFO")
-        cached_data['bank_futures'] = fetch_market_data(BANK_NIFTY_FUTURES, "NFO")
-        cached_data['last_update'] = get_ist_time()
+        # Concurrent viewers share one upstream cycle
+        segment_data, shared = coalesced_refresh(force)
+        if segment_data is None:
+            # Enough callers are already waiting on this cycle; serve the last snapshot now
+            last_update = cached_data['last_update']
+            return jsonify({
+                'status': 'success',
+                'message': 'Refresh in progress - serving last snapshot',
+                'shared': True,
+                'in_progress': True,
+                'timestamp': last_update.strftime('%Y-%m-%d %H:%M:%S IST') if last_update else None,
+                'next_poll_seconds': get_next_poll_seconds()
+            }), 202
         
         print("✅ Data refresh completed successfully!")
         
         return jsonify({
             'status': 'success',
             'message': 'Data refreshed successfully',
+            'shared': shared,
             'timestamp': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST'),
+            'next_poll_seconds': get_next_poll_seconds(),
             'data_counts': {
-                'nifty_50': len(cached_data['nifty_50']),
-                'bank_nifty': len(cached_data['bank_nifty']),
-                'pcr_data': len(cached_data['pcr_data']),
-                'nifty_futures': len(cached_data['nifty_futures']),
-                'bank_futures': len(cached_data['bank_futures'])
-            }
+                **{key: len(rows) for key, rows in segment_data.items()},
+                'pcr_data': len(cached_data['pcr_data'])
+            },
+            'fetch_health': cached_data['fetch_health']
         })
     except Exception as e:
         print(f"💥 Error in refresh_data: {e}")
@@ -870,98 +3239,312 @@ def refresh_data():
         }), 500
 
 @app.route('/api/data/<data_type>')
+@admission(fast_lane)
 def get_data(data_type):
     """Get specific data type"""
     try:
-        if data_type == 'nifty50':
-            data = cached_data.get('nifty_50', [])
-        elif data_type == 'banknifty':
-            data = cached_data.get('bank_nifty', [])
-        elif data_type == 'nifty-futures':
-            data = cached_data.get('nifty_futures', [])
-        elif data_type == 'bank-futures':
-            data = cached_data.get('bank_futures', [])
-        else:
+        segment = SEGMENTS_BY_ROUTE.get(data_type)
+        if not segment:
             return jsonify({'error': 'Invalid data type'}), 400
+        data = cached_data.get(segment['key']) or []
+        try:
+            mode = get_meter_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Calculate meter values for futures
+        # Meter values for futures come from the published snapshot
         meter_data = {}
-        if data_type in ['nifty-futures', 'bank-futures']:
-            meter_value = calculate_meter_value(data)
-            meter_status = get_meter_status(meter_value)
-            meter_data = {
-                'value': round(meter_value, 3),
-                'status': meter_status['status'],
-                'color': meter_status['color'],
-                'icon': meter_status['icon']
-            }
+        if segment['exchange'] == 'NFO':
+            meter = get_view_meters(cached_data, mode)[segment['key']]
+            meter_data = {key: meter[key] for key in ('value', 'status', 'color', 'icon')}
+        
+        # Optional paging for large segments
+        total = len(data)
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        if offset or limit:
+            data = data[offset:offset + limit if limit else None]
+        
+        try:
+            fmt = get_response_format()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if fmt != 'json':
+            return compact_response({
+                **to_columnar(data, segment['exchange']),
+                'total': total,
+                'meter': meter_data,
+                'pcr_data': segment_pcr(data, cached_data.get('pcr_data') or {}),
+                'instruments_version': INSTRUMENTS_VERSION,
+                'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None,
+                'stale': cached_data['stale']
+            }, fmt)
         
         return jsonify({
             'data': data,
+            'total': total,
             'meter': meter_data,
-            'pcr_data': cached_data.get('pcr_data', {}),
-            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None
+            'pcr_data': segment_pcr(data, cached_data.get('pcr_data') or {}),
+            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None,
+            'stale': cached_data['stale']
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/chart-data')
-def get_chart_data():
-    """Get historical chart data for futures"""
+@app.route('/api/segments')
+@admission(fast_lane)
+def get_segments():
+    """List the tracked segments and their sizes"""
+    return jsonify({
+        'segments': [
+            {
+                'key': segment['key'],
+                'route': segment['route'],
+                'label': segment['label'],
+                'exchange': segment['exchange'],
+                'instruments': len(segment['tokens']),
+                'loaded': len(cached_data.get(segment['key']) or [])
+            }
+            for segment in SEGMENTS
+        ],
+        'unique_instruments': len(INSTRUMENTS),
+        'quote_batches': len(build_fetch_plan(SEGMENTS))
+    })
+
+@app.route('/api/option-chain/<name>')
+@admission(fast_lane)
+def get_option_chain(name):
+    """OI-based PCR, max pain and OI walls for one underlying from the last refresh"""
+    try:
+        chain = cached_data['option_chains'].get(name.upper())
+        if not chain:
+            message = 'Option chain not available' if OPTION_CHAIN_ENABLED else 'Option chain engine disabled (set OPTION_CHAIN_ENABLED=true)'
+            return jsonify({'error': message}), 404
+        
+        if request.args.get('strikes', 'true').lower() == 'false':
+            chain = {key: value for key, value in chain.items() if key != 'strikes'}
+        return jsonify({
+            **chain,
+            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None,
+            'stale': cached_data['stale']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/futures-curve')
+@app.route('/api/futures-curve/<name>')
+@admission(fast_lane)
+def get_futures_curve(name=None):
+    """Near/next/far futures, rollover %, combined OI and calendar spreads from the last refresh"""
+    try:
+        curves = cached_data['futures_curves']
+        if not curves:
+            message = 'Futures curves not available' if MULTI_EXPIRY_ENABLED else 'Multi-expiry tracking disabled (set MULTI_EXPIRY_ENABLED=true)'
+            return jsonify({'error': message}), 404
+        if name:
+            curve = curves.get(name.upper())
+            if not curve:
+                return jsonify({'error': f'No futures curve for {name}'}), 404
+            curves = {curve['name']: curve}
+        return jsonify({
+            'oi_basis': ISS_OI_BASIS,
+            'curves': curves,
+            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None,
+            'stale': cached_data['stale']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/oi-series/<token>')
+@admission(fast_lane)
+def get_oi_series(token):
+    """Today's OI/LTP samples and OI analytics for one tracked futures contract (?points=false for metrics only)"""
     try:
-        # Get current futures data
-        nifty_futures = cached_data.get('nifty_futures', [])
-        bank_futures = cached_data.get('bank_futures', [])
+        slot = INSTRUMENT_SLOTS.get(('NFO', token))
+        if slot is None:
+            return jsonify({'error': f'Unknown futures contract: {token}'}), 404
+        series = oi_series.get(token) or OISeries()
+        previous_oi = oi_series_state['previous_session_oi'].get(token)
+        result = {
+            'token': token,
+            'symbol': INSTRUMENTS[slot]['symbol'],
+            'samples': len(series.oi),
+            'open_oi': series.oi[0] if series.oi else None,
+            'current_oi': series.oi[-1] if series.oi else None,
+            'previous_session_oi': previous_oi,
+            'oi_change_from_open': series.change_from_open(),
+            'oi_change_from_previous_session': series.oi[-1] - previous_oi if series.oi and previous_oi else None,
+            'oi_velocity_per_minute': round(series.velocity(request.args.get('minutes', OI_VELOCITY_MINUTES, type=int)), 2),
+            'buildup': series.buildup()
+        }
+        if request.args.get('points', 'true').lower() != 'false':
+            result.update({'times': list(series.times), 'oi': list(series.oi), 'ltp': list(series.ltp)})
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/basis')
+@admission(fast_lane)
+def get_basis():
+    """Spot-futures basis, annualised carry and premium/discount outliers (?segments=&top=&stocks=false)"""
+    try:
+        basis = cached_data.get('basis') or {}
+        routes = request.args.get('segments')
+        if routes:
+            unknown = [route for route in routes.split(',') if route not in SEGMENTS_BY_ROUTE]
+            if unknown:
+                return jsonify({'error': f"Unknown segments: {', '.join(unknown)}"}), 400
+            basis = {route: basis[route] for route in routes.split(',') if route in basis}
+        top = request.args.get('top', BASIS_TOP, type=int)
+        if top < 0:
+            return jsonify({'error': 'top must be a non-negative integer'}), 400
+        include_stocks = request.args.get('stocks', 'true').lower() != 'false'
+        return jsonify({
+            'segments': {
+                route: {
+                    **{key: value for key, value in entry.items() if include_stocks or key != 'stocks'},
+                    'premium': entry['stocks'][:top],
+                    'discount': entry['stocks'][::-1][:top]
+                }
+                for route, entry in basis.items()
+            },
+            'outlier_z': BASIS_OUTLIER_Z,
+            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None,
+            'stale': cached_data['stale']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/instruments')
+@admission(fast_lane)
+def get_instruments():
+    """
+    Static instrument metadata and segment membership. Compact responses
+    refer to instruments by slot, so this is fetched once and cached.
+    """
+    if INSTRUMENTS_VERSION in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = compact_response({
+            'version': INSTRUMENTS_VERSION,
+            'fields': ['exchange', 'token', 'symbol', 'name', 'company'],
+            'instruments': [
+                [instrument['exchange'], instrument['token'], instrument['symbol'], instrument['name'], instrument['company']]
+                for instrument in INSTRUMENTS
+            ],
+            'segments': {
+                segment['route']: {
+                    'key': segment['key'],
+                    'label': segment['label'],
+                    'exchange': segment['exchange'],
+                    'slots': [info['slot'] for info in segment['tokens'].values()],
+                    'weights': [info['weight'] for info in segment['tokens'].values()]
+                }
+                for segment in SEGMENTS
+            }
+        }, request.args.get('format', 'json') if msgpack else 'json')
+    response.set_etag(INSTRUMENTS_VERSION)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+@app.route('/api/dashboard')
+@admission(fast_lane)
+def get_dashboard():
+    """
+    Every segment, both meters and the chart history from one consistent
+    snapshot. ?segments=nifty50,bank-futures and ?fields=ltp,percentChange
+    project the response; ?history=false drops the chart history.
+    """
+    try:
+        view = dict(cached_data)  # Shallow copy: everything below comes from the same published snapshot
+        try:
+            fmt = get_response_format()
+            mode = get_meter_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Calculate current meter values
-        nifty_meter = calculate_meter_value(nifty_futures) if nifty_futures else 0
-        bank_meter = calculate_meter_value(bank_futures) if bank_futures else 0
+        etag = f"{view['snapshot_version']}-{zlib.crc32(request.query_string):08x}"
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
         
-        # Get impact status
-        nifty_impact = get_meter_status(nifty_meter)
-        bank_impact = get_meter_status(bank_meter)
+        routes = request.args.get('segments')
+        if routes:
+            unknown = [route for route in routes.split(',') if route not in SEGMENTS_BY_ROUTE]
+            if unknown:
+                return jsonify({'error': f"Invalid segments: {', '.join(unknown)}"}), 400
+            segments = [SEGMENTS_BY_ROUTE[route] for route in routes.split(',')]
+        else:
+            segments = SEGMENTS
         
-        # Get current timestamp
-        current_time = get_ist_time()
-        timestamp = current_time.strftime('%H:%M')
+        fields = request.args.get('fields')
+        if fields:
+            fields = [field for field in fields.split(',') if field and field != 'token']
         
-        # Add current data to history (limit to last 100 points)
-        if nifty_futures and bank_futures:
-            # Store chart data point
-            chart_point = {
-                'timestamp': timestamp,
-                'time_full': current_time.strftime('%Y-%m-%d %H:%M:%S'),
-                'nifty_meter': round(nifty_meter, 3),
-                'bank_meter': round(bank_meter, 3),
-                'nifty_impact': nifty_impact,
-                'bank_impact': bank_impact
-            }
-            
-            # Update history arrays
-            nifty_history = cached_data['chart_data']['nifty_futures_history']
-            bank_history = cached_data['chart_data']['bank_futures_history']
-            
-            # Add current point and keep last 100 points
-            nifty_history.append(chart_point)
-            bank_history.append(chart_point)
-            
-            if len(nifty_history) > 100:
-                nifty_history.pop(0)
-            if len(bank_history) > 100:
-                bank_history.pop(0)
+        meters = get_view_meters(view, mode)
+        pcr_data = view.get('pcr_data') or {}
+        payload_segments = {}
+        for segment in segments:
+            rows = view.get(segment['key']) or []
+            if fmt != 'json':
+                entry = to_columnar(rows, segment['exchange'], fields)
+            elif fields:
+                entry = {'data': [{field: row[field] for field in ['token'] + fields if field in row} for row in rows]}
+            else:
+                entry = {'data': rows}
+            entry['total'] = len(rows)
+            if segment['exchange'] == 'NFO':
+                entry['meter'] = meters[segment['key']]
+                entry['pcr_data'] = segment_pcr(rows, pcr_data)
+            payload_segments[segment['route']] = entry
         
-        return jsonify({
+        payload = {
             'status': 'success',
-            'nifty_futures_history': cached_data['chart_data']['nifty_futures_history'],
-            'bank_futures_history': cached_data['chart_data']['bank_futures_history'],
-            'current': {
-                'nifty_meter': round(nifty_meter, 3),
-                'bank_meter': round(bank_meter, 3),
-                'nifty_impact': nifty_impact,
-                'bank_impact': bank_impact,
-                'timestamp': timestamp
+            'snapshot_version': view['snapshot_version'],
+            'segments': payload_segments,
+            'meters': {
+                'nifty_meter': meters['nifty_futures'],
+                'bank_meter': meters['bank_futures']
             },
-            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None
+            'last_update': view['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if view['last_update'] else None,
+            'stale': view['stale']
+        }
+        if request.args.get('history', 'true').lower() != 'false':
+            payload['chart'] = build_chart_payload(view, meters)
+        
+        if fmt != 'json':
+            payload['instruments_version'] = INSTRUMENTS_VERSION
+            return compact_response(payload, fmt, etag)
+        response = jsonify(payload)
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        print(f"💥 Error in get_dashboard: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error building dashboard: {str(e)}'
+        }), 500
+
+@app.route('/api/chart-data')
+@admission(fast_lane)
+def get_chart_data():
+    """Get historical chart data for futures"""
+    try:
+        # History is appended once per published snapshot, so reads are side-effect free
+        try:
+            mode = get_meter_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        view = dict(cached_data)
+        meters = get_view_meters(view, mode)
+        
+        return jsonify({
+            'status': 'success',
+            **build_chart_payload(view, meters),
+            'last_update': view['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if view['last_update'] else None,
+            'stale': view['stale']
         })
     except Exception as e:
         print(f"💥 Error in get_chart_data: {e}")
@@ -971,6 +3554,7 @@ def get_chart_data():
         }), 500
 
 @app.route('/api/debug')
+@admission(heavy_lane)
 def debug_api():
     """Debug endpoint to test API connectivity"""
     try:
@@ -1025,6 +3609,7 @@ def debug_api():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/debug-pcr')
+@admission(heavy_lane)
 def debug_pcr():
     try:
         headers = {
@@ -1058,33 +3643,298 @@ def debug_pcr():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/meters')
+@admission(fast_lane)
 def get_meters():
     """Get both meter values"""
     try:
-        nifty_meter = 0
-        bank_meter = 0
+        try:
+            mode = get_meter_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        meters = get_view_meters(cached_data, mode)
+        used = {meters['nifty_futures']['mode'], meters['bank_futures']['mode']}
+        
+        return jsonify({
+            # Adaptive falls back to fixed per index until ISS_MIN_SAMPLES snapshots are seen
+            'mode': used.pop() if len(used) == 1 else 'mixed',
+            'requested_mode': mode,
+            'nifty_meter': meters['nifty_futures'],
+            'bank_meter': meters['bank_futures'],
+            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None,
+            'stale': cached_data['stale']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/iss-stats')
+def get_iss_stats():
+    """Rolling mean/std of each ISS component per index (used by adaptive normalisation)"""
+    try:
+        return jsonify({
+            'mode': ISS_NORMALIZATION_MODE,
+            'halflife_snapshots': ISS_STATS_HALFLIFE,
+            'min_samples': ISS_MIN_SAMPLES,
+            'indices': {
+                index_key: {
+                    name: {
+                        'count': stats.count,
+                        'mean': round(stats.mean, 4),
+                        'std': round(stats.variance ** 0.5, 4),
+                        'ewma_mean': round(stats.ewma_mean, 4),
+                        'ewma_std': round(stats.ewma_var ** 0.5, 4)
+                    }
+                    for name, stats in components.items()
+                }
+                for index_key, components in iss_stats.items()
+            }
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/baskets', methods=['GET', 'POST'])
+def baskets():
+    """List basket meters, or register/replace a basket (POST {name, label, members})"""
+    global basket_registry, basket_matrix
+    try:
+        try:
+            mode = get_meter_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if request.method == 'POST':
+            body = request.get_json(silent=True) or {}
+            name = str(body.get('name', ''))
+            if not name or len(name) > 64 or not set(name) <= BASKET_NAME_CHARS:
+                return jsonify({'error': 'name must be 1-64 letters, digits, "_" or "-"'}), 400
+            members = body.get('members')
+            try:
+                compile_basket(members)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            with basket_registry_lock:
+                if name not in basket_registry and len(basket_registry) >= BASKET_LIMIT:
+                    return jsonify({'error': f'Basket limit ({BASKET_LIMIT}) reached'}), 400
+                registry = {**basket_registry, name: {'label': body.get('label') or name, 'members': members}}
+                save_baskets(registry)
+                basket_matrix = compile_basket_matrix(registry)
+                basket_registry = registry
+                # Score against the current snapshot so the new basket is visible immediately
+                cached_data['baskets'] = evaluate_baskets(cached_data)
+                view_cache.clear()
+            print(f"🧺 Registered basket {name} ({len(members)} members)")
         
-        if cached_data.get('nifty_futures'):
-            nifty_meter = calculate_meter_value(cached_data['nifty_futures'])
+        view = dict(cached_data)
+        meters = get_view_baskets(view, mode)
+        names = request.args.get('names')
+        names = names.split(',') if names else list(meters)
+        registry = basket_registry
+        return jsonify({
+            'snapshot_version': view['snapshot_version'],
+            'last_update': view['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if view['last_update'] else None,
+            'stale': view['stale'],
+            'baskets': {
+                name: {'label': registry[name]['label'], 'size': len(registry[name]['members']), **meters[name]}
+                for name in names if name in meters and name in registry
+            }
+        })
+    except Exception as e:
+        print(f"💥 Error in baskets: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/baskets/<name>', methods=['DELETE'])
+def delete_basket(name):
+    """Remove a basket from the registry"""
+    global basket_registry, basket_matrix
+    try:
+        with basket_registry_lock:
+            if name not in basket_registry:
+                return jsonify({'error': f'Unknown basket: {name}'}), 404
+            registry = {key: basket for key, basket in basket_registry.items() if key != name}
+            save_baskets(registry)
+            basket_matrix = compile_basket_matrix(registry)
+            basket_registry = registry
+            cached_data['baskets'] = {key: meter for key, meter in cached_data['baskets'].items() if key != name}
+            view_cache.clear()
+            iss_stats.pop(basket_stats_key(name), None)
+        return jsonify({'status': 'success', 'deleted': name})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/alerts')
+def get_alerts():
+    """Recently fired alerts, optionally only those after ?since=<seq>"""
+    since = request.args.get('since', 0, type=int)
+    return jsonify({'alerts': [alert for alert in alert_history if alert['seq'] > since]})
+
+@app.route('/api/alerts/rules', methods=['GET', 'POST'])
+def alert_rules():
+    """List alert rules, or add one (POST {source, target|symbol|token, field, op, threshold|to})"""
+    try:
+        if request.method == 'POST':
+            try:
+                rule = normalize_alert_rule(request.get_json(silent=True) or {})
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            alert_engine.add(rule)
+            save_alert_rules()
+            print(f"🔔 Added alert rule {rule['id']}")
+            return jsonify({'status': 'success', 'rule': rule})
+        return jsonify({'rules': list(alert_engine.rules.values())})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/alerts/rules/<rule_id>', methods=['DELETE'])
+def delete_alert_rule(rule_id):
+    """Remove an alert rule"""
+    try:
+        if not alert_engine.remove(rule_id):
+            return jsonify({'error': f'Unknown rule: {rule_id}'}), 404
+        save_alert_rules()
+        return jsonify({'status': 'success', 'deleted': rule_id})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/alerts/stream')
+@admission(stream_lane)
+def alert_stream():
+    """Server-sent events for fired alerts (each connection lasts ALERT_STREAM_SECONDS)"""
+    subscriber = queue.Queue(maxsize=100)
+    with alert_subscribers_lock:
+        if len(alert_subscribers) >= ALERT_STREAM_MAX_CLIENTS:
+            response = jsonify({'error': f'Too many alert streams (limit {ALERT_STREAM_MAX_CLIENTS}); poll /api/alerts?since= instead'})
+            response.headers['Retry-After'] = str(ALERT_STREAM_SECONDS)
+            return response, 503
+        alert_subscribers.add(subscriber)
+    
+    def events():
+        deadline = time.monotonic() + ALERT_STREAM_SECONDS
+        try:
+            yield 'retry: 5000\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    alert = subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"id: {alert['seq']}\nevent: alert\ndata: {json.dumps(alert)}\n\n"
+        finally:
+            alert_subscribers.discard(subscriber)
+    
+    response = app.response_class(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # A client that disconnects before the first event never enters events()
+    response.call_on_close(lambda: alert_subscribers.discard(subscriber))
+    return response
+
+@app.route('/api/candles/<token>')
+@admission(heavy_lane)
+def get_candle_data(token):
+    """Intraday candles for one tracked instrument (?interval=&from=&to=&exchange=)"""
+    try:
+        exchange = request.args.get('exchange') or next(
+            (exchange for exchange in ('NSE', 'NFO') if (exchange, token) in INSTRUMENT_SLOTS), None)
+        slot = INSTRUMENT_SLOTS.get((exchange, token))
+        if slot is None:
+            return jsonify({'error': f'Unknown instrument: {token}'}), 404
+        interval = request.args.get('interval', 'FIVE_MINUTE')
+        if interval not in CANDLE_INTERVALS:
+            return jsonify({'error': f"interval must be one of {', '.join(CANDLE_INTERVALS)}"}), 400
         
-        if cached_data.get('bank_futures'):
-            bank_meter = calculate_meter_value(cached_data['bank_futures'])
+        now = get_ist_time()
+        default_day = now.date() if is_trading_day(now.date()) and now.time() >= SESSION_OPEN else get_previous_trading_day()
+        try:
+            last_day = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else default_day
+            first_day = datetime.strptime(request.args['from'], '%Y-%m-%d').date() if request.args.get('from') else last_day
+        except ValueError:
+            return jsonify({'error': 'from/to must be YYYY-MM-DD'}), 400
+        if first_day > last_day or (last_day - first_day).days >= CANDLE_MAX_WINDOW_DAYS:
+            return jsonify({'error': f'Window must be 1-{CANDLE_MAX_WINDOW_DAYS} days'}), 400
         
+        if not cached_data.get('auth_token') and not authenticate():
+            return jsonify({'error': 'Authentication failed'}), 500
+        records, failed = get_candles(exchange, token, interval, first_day, last_day, now)
         return jsonify({
-            'nifty_meter': {
-                'value': round(nifty_meter, 3),
-                **get_meter_status(nifty_meter)
-            },
-            'bank_meter': {
-                'value': round(bank_meter, 3),
-                **get_meter_status(bank_meter)
-            },
-            'last_update': cached_data['last_update'].strftime('%Y-%m-%d %H:%M:%S IST') if cached_data['last_update'] else None
+            'token': token,
+            'exchange': exchange,
+            'symbol': INSTRUMENTS[slot]['symbol'],
+            'interval': interval,
+            'fields': CANDLE_FIELDS,
+            'candles': records,
+            'missing_days': [day.isoformat() for day in failed]
         })
     except Exception as e:
+        print(f"💥 Error in get_candle_data: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/candles/prefetch', methods=['POST'])
+@admission(heavy_lane)
+def start_candle_prefetch():
+    """Fill today's (or the last session's) candles for every tracked instrument in the background"""
+    interval = request.args.get('interval', 'FIVE_MINUTE')
+    if interval not in CANDLE_INTERVALS:
+        return jsonify({'error': f"interval must be one of {', '.join(CANDLE_INTERVALS)}"}), 400
+    if candle_prefetch['running']:
+        return jsonify({'status': 'running', **candle_prefetch})
+    if not cached_data.get('auth_token') and not authenticate():
+        return jsonify({'error': 'Authentication failed'}), 500
+    
+    now = get_ist_time()
+    day = now.date() if is_trading_day(now.date()) and now.time() >= SESSION_OPEN else get_previous_trading_day()
+    candle_prefetch['running'] = True
+    threading.Thread(target=prefetch_candles, args=(interval, day), name='candle-prefetch', daemon=True).start()
+    return jsonify({'status': 'started', 'day': day.isoformat(), 'interval': interval, 'instruments': len(INSTRUMENTS)})
+
+@app.route('/api/export')
+@admission(stream_lane)
+def export_snapshots():
+    """
+    Stream every snapshot of a day (?date=YYYY-MM-DD, default today) for the
+    chosen segments as CSV or NDJSON (?format=), one snapshot at a time.
+    """
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d').date() if request.args.get('date') else get_ist_time().date()
+    except ValueError:
+        return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    routes = request.args.get('segments')
+    if routes:
+        unknown = [route for route in routes.split(',') if route not in SEGMENTS_BY_ROUTE]
+        if unknown:
+            return jsonify({'error': f"Unknown segments: {', '.join(unknown)}"}), 400
+        segments = [SEGMENTS_BY_ROUTE[route] for route in routes.split(',')]
+    else:
+        segments = SEGMENTS
+    if not os.path.exists(journal_path(day)):
+        return jsonify({'error': f'No snapshots recorded for {day.isoformat()}'}), 404
+    
+    columns = ['snapshot_version', 'time', 'segment', *JOURNAL_FIELDS]
+    
+    def generate():
+        if fmt == 'ndjson':
+            for row in export_rows(day, segments):
+                yield json.dumps(row, separators=(',', ':')) + '\n'
+            return
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns)
+        writer.writeheader()
+        for row in export_rows(day, segments):
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    filename = f"snapshots-{day.isoformat()}.{fmt}"
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
 @app.route('/test_historical_oi/<token>')
+@admission(heavy_lane)
 def test_historical_oi(token):
     """Test endpoint to check historical OI API"""
     if not authenticate():
@@ -1094,8 +3944,31 @@ def test_historical_oi(token):
     return jsonify({
         "token": token,
         "historical_oi": result,
-        "cache": cached_data.get('historical_oi_cache', {})
+        "cache": historical_oi_cache.summary(request.args.get('offset', 0, type=int), min(request.args.get('limit', 50, type=int), 500))
     })
 
+@app.route('/api/admission')
+@admission(fast_lane)
+def get_admission_stats():
+    """Queue depth, admissions and rejections per admission lane"""
+    return jsonify({name: lane.stats() for name, lane in ADMISSION_LANES.items()})
+
+@app.route('/api/cache-stats')
+def get_cache_stats():
+    """Hit/miss/eviction counters and memory use of every in-process cache (?name= for paged entries)"""
+    name = request.args.get('name')
+    if name:
+        if name not in CACHES:
+            return jsonify({'error': f'Unknown cache: {name}'}), 404
+        return jsonify(CACHES[name].summary(request.args.get('offset', 0, type=int), min(request.args.get('limit', 50, type=int), 500)))
+    return jsonify({name: cache.stats() for name, cache in CACHES.items()})
+
+# Restore persisted state at import time (gunicorn never runs __main__)
+load_iss_stats()
+load_baskets()
+load_alert_rules()
+load_oi_series()
+warm_start()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file